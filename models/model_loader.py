@@ -1,16 +1,85 @@
+import cv2
+import logging
 import yaml
 import paddle
+from log import loggers
 from modules.layoutlmv3.model_init import Layoutlmv3_Predictor
 from modules.self_modify import ModifiedPaddleOCR
+from parsers.layout_batch import DEFAULT_BUCKETS
+
+logger = loggers("layout", level=logging.INFO)
 
 
 class LayoutModel:
-    def __init__(self, weight):
-        self.model = Layoutlmv3_Predictor(weight)
+    def __init__(
+        self,
+        weight,
+        profile="inference",
+        token_pruning=None,
+        backend="torch",
+        onnx=None,
+        device=None,
+        quantization=None,
+        precision="fp32",
+        compile=None,
+        postprocess=None,
+        batching=None,
+    ):
+        token_pruning = dict(token_pruning or {})
+        compile = dict(compile or {})
+        batching = dict(batching or {})
+        if compile.pop("enabled", False):
+            if batching.get("enabled"):
+                # one graph per bucket for single pages, one for batches
+                buckets = batching.get("buckets", DEFAULT_BUCKETS)
+                compile.setdefault("recompile_limit", 2 * len(buckets))
+            elif not compile.get("dynamic"):
+                logger.warning(
+                    "Layout compilation needs batching or compile.dynamic, "
+                    "every page size would compile separately; running eager"
+                )
+                compile = None
+        else:
+            compile = None
+        self.model = Layoutlmv3_Predictor(
+            weight,
+            profile=profile,
+            token_pruning=(
+                token_pruning if token_pruning.pop("enabled", False) else None
+            ),
+            backend=backend,
+            onnx=onnx,
+            device=device,
+            quantization=quantization,
+            precision=precision,
+            compile=compile,
+            postprocess=postprocess,
+        )
+
+    @property
+    def input_size(self):
+        return self.model.input_size
+
+    @property
+    def size_divisibility(self):
+        return self.model.size_divisibility
+
+    def input_shape(self, height, width):
+        return self.model.input_shape(height, width)
 
     def __call__(self, image, ignore_catids=[]):
+        if image.ndim == 2:
+            # grayscale pages are only expanded to three channels here
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
         return self.model(image, ignore_catids=ignore_catids)
 
+    def batch(self, images, ignore_catids=[], pad_to=None):
+        images = [
+            cv2.cvtColor(image, cv2.COLOR_GRAY2BGR) if image.ndim == 2 else image
+            for image in images
+        ]
+        return self.model.batch(images, ignore_catids=ignore_catids, pad_to=pad_to)
+
 
 class OCRModel:
     def __init__(self):
@@ -27,5 +96,23 @@ class ModelLoader:
             model_configs = yaml.load(f, Loader=yaml.FullLoader)
         self.device: str = model_configs["model_args"]["device"]
         self.dpi: int = model_configs["model_args"]["pdf_dpi"]
-        self.layout_model = LayoutModel(model_configs["model_args"]["layout_weight"])
+        self.render_args: dict = model_configs.get("render_args", {})
+        self.upload_args: dict = model_configs.get("upload_args", {})
+        self.encoder_args: dict = model_configs.get("encoder_args", {})
+        self.crop_args: dict = model_configs.get("crop_args", {})
+        self.ingest_args: dict = model_configs.get("ingest_args", {})
+        self.layout_args: dict = model_configs.get("layout_args", {})
+        self.layout_model = LayoutModel(
+            model_configs["model_args"]["layout_weight"],
+            profile=model_configs["model_args"].get("layout_profile", "inference"),
+            token_pruning=self.layout_args.get("token_pruning"),
+            backend=self.layout_args.get("backend", "torch"),
+            onnx=self.layout_args.get("onnx"),
+            device=self.device,
+            quantization=self.layout_args.get("quantization"),
+            precision=self.layout_args.get("precision", "fp32"),
+            compile=self.layout_args.get("compile"),
+            batching=self.layout_args.get("batching"),
+            postprocess=self.layout_args.get("postprocess"),
+        )
         self.ocr_model = OCRModel()
@@ -1,26 +1,551 @@
+import hashlib
+import math
 import os
+import re
+import threading
 import fitz
+from collections import OrderedDict
+from contextlib import contextmanager
 import numpy as np
 from tqdm import tqdm
 from PIL import Image
-from typing import Any
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Union,
+)
+from .tiling import Tiling, plan_tiles
+
+
+def open_pdf(pdf_path: Union[str, bytes]) -> fitz.Document:
+    # raw bytes come from in-memory downloads and never touch the disk
+    if isinstance(pdf_path, (bytes, bytearray, memoryview)):
+        return fitz.open(stream=pdf_path, filetype="pdf")
+    return fitz.open(pdf_path)
+
+
+# bytes searched for the linearization dictionary at the start of a file
+LINEARIZATION_PROBE = 1024
+
+
+class Linearization(NamedTuple):
+    # /L: file length the linearization was written for
+    length: int
+    # /E: offset of the end of the first page's objects
+    first_page_end: int
+    # /N: number of pages
+    page_count: int
+    # /O: object number of the first page
+    first_page_object: int
+
+
+def linearization(head: bytes) -> Optional[Linearization]:
+    """Parameters of the linearization dictionary in `head`, if there is one."""
+    match = re.search(rb"<<\s*/Linearized\b(.*?)>>", head[:LINEARIZATION_PROBE], re.S)
+    if match is None:
+        return None
+    values = {}
+    for key in (b"L", b"E", b"N", b"O"):
+        value = re.search(rb"/" + key + rb"\s+(\d+)", match.group(1))
+        if value is None:
+            return None
+        values[key] = int(value.group(1))
+    return Linearization(values[b"L"], values[b"E"], values[b"N"], values[b"O"])
+
+
+def first_page_document(head: bytes, info: Linearization) -> bytes:
+    """
+    A standalone one-page PDF from the first `info.first_page_end` bytes of a
+    linearized file. MuPDF repairs the truncated file, but its page tree lives
+    past the first page, so the first page object gets a page tree of its own.
+    """
+    doc = fitz.open(stream=head[: info.first_page_end], filetype="pdf")
+    try:
+        pages = doc.get_new_xref()
+        doc.update_object(
+            pages, f"<< /Type /Pages /Kids [{info.first_page_object} 0 R] /Count 1 >>"
+        )
+        doc.xref_set_key(info.first_page_object, "Parent", f"{pages} 0 R")
+        doc.xref_set_key(doc.pdf_catalog(), "Pages", f"{pages} 0 R")
+        return doc.tobytes()
+    finally:
+        doc.close()
+
+
+def document_key(pdf_path: Union[str, bytes]) -> Tuple:
+    """Identity of a document's content: path, mtime and size, or a bytes digest."""
+    if isinstance(pdf_path, (bytes, bytearray, memoryview)):
+        return ("bytes", hashlib.blake2b(pdf_path, digest_size=16).hexdigest())
+    st = os.stat(pdf_path)
+    return ("path", os.path.abspath(pdf_path), st.st_mtime_ns, st.st_size)
+
+
+def available_memory() -> Optional[int]:
+    """
+    MemAvailable, which counts reclaimable page cache; free pages only where
+    /proc/meminfo does not report it.
+    """
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+class _CachedDocument:
+    def __init__(self, doc: fitz.Document):
+        self.doc = doc
+        # fitz documents must not be used from several threads at once
+        self.lock = threading.Lock()
+        self.users = 0
+
+
+class DocumentCache:
+    """
+    Bounded LRU of open fitz documents, so repeated access to one PDF (page
+    ranges, clips, retries) does not reopen it and re-parse its xref. Each
+    process has its own cache; render workers keep theirs across tasks.
+    Idle handles are closed when the LRU is full or available memory drops
+    below `min_available_bytes`.
+    """
+
+    def __init__(self, max_documents: int = 8, min_available_bytes: int = 512 << 20):
+        self.max_documents = max_documents
+        self.min_available_bytes = min_available_bytes
+        self._entries: "OrderedDict[Tuple, _CachedDocument]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key: Tuple) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    @contextmanager
+    def checkout(
+        self, pdf_path: Union[str, bytes], key: Optional[Tuple] = None
+    ) -> Iterator[fitz.Document]:
+        """Hold the document of `pdf_path` exclusively for the `with` block."""
+        if key is None:
+            key = document_key(pdf_path)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                entry.users += 1
+        if entry is None:
+            opened = _CachedDocument(open_pdf(pdf_path))
+            with self._lock:
+                # another thread may have opened the same document meanwhile
+                entry = self._entries.setdefault(key, opened)
+                entry.users += 1
+                self._evict()
+            if entry is not opened:
+                opened.doc.close()
+        try:
+            with entry.lock:
+                yield entry.doc
+        finally:
+            with self._lock:
+                entry.users -= 1
+                self._evict()
+
+    def _evict(self):
+        def under_pressure():
+            if len(self._entries) > self.max_documents:
+                return True
+            available = available_memory()
+            return available is not None and available < self.min_available_bytes
+
+        for key in list(self._entries):
+            if not under_pressure():
+                break
+            entry = self._entries[key]
+            if entry.users == 0:
+                del self._entries[key]
+                entry.doc.close()
+
+    def clear(self):
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if entry.users == 0:
+                    del self._entries[key]
+                    entry.doc.close()
+
+
+_document_cache = DocumentCache()
+
+
+def configure_document_cache(**kwargs):
+    """Replace this process's document cache, e.g. as a pool initializer."""
+    global _document_cache
+    _document_cache.clear()
+    _document_cache = DocumentCache(**kwargs)
+
+
+def get_document_cache() -> DocumentCache:
+    return _document_cache
+
+
+def page_count(pdf_path: Union[str, bytes]) -> int:
+    with _document_cache.checkout(pdf_path) as doc:
+        return len(doc)
+
+
+# pages larger than this at the requested dpi are rendered at 72 dpi, or in
+# tiles when tiling is enabled
+MAX_RENDER_SIDE = 3000
+# thumbnail size and channel spread used to detect colourless pages
+COLOR_PROBE_SIDE = 128
+COLOR_TOLERANCE = 24
+
+
+class PageBufferPool:
+    """
+    Reusable page-sized image buffers. Steady-state rendering of same-sized
+    pages then allocates nothing; buffers return to the pool when the
+    RenderedPage holding them is released.
+    """
+
+    def __init__(self, max_buffers: int = 8):
+        self.max_buffers = max_buffers
+        self._free: Dict[Tuple[int, ...], List[np.ndarray]] = {}
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, shape: Tuple[int, ...]) -> np.ndarray:
+        with self._lock:
+            buffers = self._free.get(shape)
+            if buffers:
+                self._count -= 1
+                return buffers.pop()
+        return np.empty(shape, dtype=np.uint8)
+
+    def release(self, buffer: np.ndarray):
+        with self._lock:
+            if self._count >= self.max_buffers:
+                return
+            self._free.setdefault(buffer.shape, []).append(buffer)
+            self._count += 1
+
+
+class PageGeometry(NamedTuple):
+    # pixels per PDF point of the rendered raster
+    scale: float
+    # pixels per PDF point of the coordinates reported to clients
+    output_scale: float
+    # (height, width) of the page in output pixels
+    output_size: Tuple[int, int]
+    # single-channel raster, expanded to BGR only at model input
+    gray: bool = False
+    # for tiled pages, the (x0, y0, x1, y1) output-pixel box of each tile; the
+    # image then stacks one equally sized raster per tile
+    tiles: Tuple[Tuple[int, int, int, int], ...] = ()
+
+
+class RenderedPage:
+    """A rendered BGR page image and the geometry it was rendered with."""
+
+    def __init__(
+        self,
+        image: np.ndarray,
+        geometry: PageGeometry,
+        pool: Optional[PageBufferPool] = None,
+    ):
+        self.image = image
+        self.geometry = geometry
+        self._pool = pool
+
+    @property
+    def scale(self) -> float:
+        return self.geometry.scale
+
+    @property
+    def output_scale(self) -> float:
+        return self.geometry.output_scale
+
+    @property
+    def output_size(self) -> Tuple[int, int]:
+        return self.geometry.output_size
+
+    @property
+    def gray(self) -> bool:
+        return self.geometry.gray
+
+    @property
+    def tiles(self) -> Tuple[Tuple[int, int, int, int], ...]:
+        return self.geometry.tiles
+
+    @property
+    def dpi(self) -> int:
+        return round(self.geometry.output_scale * 72)
+
+    def release(self):
+        if self._pool is not None and self.image is not None:
+            self._pool.release(self.image)
+        self.image = None
+
+
+def is_oversized(page: fitz.Page, scale: float) -> bool:
+    rect = page.rect
+    return rect.width * scale > MAX_RENDER_SIDE or rect.height * scale > MAX_RENDER_SIDE
+
+
+def render_scale(page: fitz.Page, dpi: float) -> float:
+    # decide from the page geometry up front, so oversized pages are rendered once
+    scale = dpi / 72
+    if is_oversized(page, scale):
+        scale = 1
+    return scale
+
+
+class DpiPolicy:
+    """
+    Chooses a render dpi per page from cheap signals: the smallest font size
+    in the text layer, the native resolution of embedded images (scans) and a
+    pixel budget for the page.
+    """
+
+    def __init__(
+        self,
+        min_dpi: int = 100,
+        max_dpi: int = 300,
+        target_font_px: int = 20,
+        max_pixels: int = 16_000_000,
+        min_font_size: float = 3.0,
+    ):
+        self.min_dpi = min_dpi
+        self.max_dpi = max_dpi
+        self.target_font_px = target_font_px
+        self.max_pixels = max_pixels
+        # smaller spans are usually invisible or decorative text
+        self.min_font_size = min_font_size
+
+    def font_dpi(self, page: fitz.Page) -> Optional[float]:
+        sizes = [
+            span["size"]
+            for span in page.get_texttrace()
+            if span["size"] >= self.min_font_size
+        ]
+        if not sizes:
+            return None
+        return self.target_font_px * 72 / min(sizes)
+
+    @staticmethod
+    def image_dpi(page: fitz.Page) -> Optional[float]:
+        dpis = []
+        for info in page.get_image_info():
+            bbox = fitz.Rect(info["bbox"]) & page.rect
+            if bbox.is_empty or bbox.width < page.rect.width / 4:
+                continue
+            dpis.append(info["width"] * 72 / bbox.width)
+        return max(dpis) if dpis else None
+
+    def choose(
+        self, page: fitz.Page, default_dpi: int, max_side: Optional[int] = None
+    ) -> float:
+        """
+        The page's dpi. With `max_side`, the longest rendered side stays
+        within it, so untiled pages are not sent to the 72 dpi fallback.
+        """
+        signals = [d for d in (self.font_dpi(page), self.image_dpi(page)) if d]
+        dpi = max(signals) if signals else default_dpi
+        dpi = min(max(dpi, self.min_dpi), self.max_dpi)
+        area = page.rect.width * page.rect.height / 72**2
+        budget_dpi = (self.max_pixels / area) ** 0.5 if area else dpi
+        dpi = min(dpi, budget_dpi)
+        long_side = max(page.rect.width, page.rect.height)
+        if max_side and long_side:
+            # whole dpis, so rounding cannot push a side past the limit
+            dpi = min(dpi, math.floor(max_side * 72 / long_side))
+        return dpi
+
+
+def layout_scale(page: fitz.Page, layout_size: Tuple[int, int]) -> float:
+    """Scale matching the layout model's ResizeShortestEdge(min_size, max_size)."""
+    min_size, max_size = layout_size
+    short_side, long_side = sorted((page.rect.width, page.rect.height))
+    scale = min_size / short_side
+    if long_side * scale > max_size:
+        scale = max_size / long_side
+    return scale
+
+
+def is_colorless(page: fitz.Page) -> bool:
+    """Cheap check on a small RGB thumbnail whether the page has any colour."""
+    scale = COLOR_PROBE_SIDE / max(page.rect.width, page.rect.height)
+    pix = page.get_pixmap(matrix=fitz.Matrix(scale, scale), alpha=False)
+    rgb = pixmap_to_array(pix)
+    spread = rgb.max(axis=2).astype(np.int16) - rgb.min(axis=2)
+    # tolerate a few anti-aliased pixels
+    return np.count_nonzero(spread > COLOR_TOLERANCE) <= spread.size // 1000
+
+
+def pixmap_to_array(pix: fitz.Pixmap) -> np.ndarray:
+    """View the pixmap samples as an (H, W, N) array without copying."""
+    samples = np.frombuffer(pix.samples_mv, dtype=np.uint8)
+    samples = samples.reshape(pix.height, pix.stride)[:, : pix.width * pix.n]
+    return samples.reshape(pix.height, pix.width, pix.n)
+
+
+def render_into(
+    page: fitz.Page,
+    dpi: int,
+    allocate: Callable[[Tuple[int, ...]], np.ndarray],
+    layout_size: Optional[Tuple[int, int]] = None,
+    color_mode: str = "rgb",
+    dpi_policy: Optional[DpiPolicy] = None,
+    tiling: Optional[Tiling] = None,
+) -> Tuple[np.ndarray, PageGeometry]:
+    """
+    Render `page` into a buffer obtained from `allocate(shape)`, as BGR or, for
+    `color_mode` "gray" and colourless pages under "auto", as one channel.
+    With `layout_size` the raster is rendered directly at the layout model's
+    input size; coordinates are still reported at `dpi`, or at the per-page
+    dpi picked by `dpi_policy`. With `tiling`, oversized pages keep their dpi
+    and are rendered as a stack of overlapping tiles.
+    """
+    if dpi_policy is not None:
+        dpi = dpi_policy.choose(
+            page, dpi, max_side=None if tiling is not None else MAX_RENDER_SIDE
+        )
+    gray = color_mode == "gray" or (color_mode == "auto" and is_colorless(page))
+    if tiling is not None and is_oversized(page, dpi / 72):
+        return render_tiles(page, dpi / 72, allocate, tiling, layout_size, gray)
+    output_scale = render_scale(page, dpi)
+    scale = output_scale if layout_size is None else layout_scale(page, layout_size)
+    matrix = fitz.Matrix(scale, scale)
+    if gray:
+        pix = page.get_pixmap(matrix=matrix, colorspace=fitz.csGRAY, alpha=False)
+        samples = pixmap_to_array(pix)[:, :, 0]
+    else:
+        pix = page.get_pixmap(matrix=matrix, alpha=False)
+        # downstream stages expect BGR; the channel flip is the only copy made
+        samples = pixmap_to_array(pix)[:, :, ::-1]
+    image = allocate(samples.shape)
+    np.copyto(image, samples)
+    output_rect = (page.rect * fitz.Matrix(output_scale, output_scale)).irect
+    geometry = PageGeometry(
+        scale, output_scale, (output_rect.height, output_rect.width), gray
+    )
+    return image, geometry
+
+
+def render_tiles(
+    page: fitz.Page,
+    output_scale: float,
+    allocate: Callable[[Tuple[int, ...]], np.ndarray],
+    tiling: Tiling,
+    layout_size: Optional[Tuple[int, int]] = None,
+    gray: bool = False,
+) -> Tuple[np.ndarray, PageGeometry]:
+    """Render the tiles of an oversized page into one (n, h, w[, 3]) buffer."""
+    output_rect = (page.rect * fitz.Matrix(output_scale, output_scale)).irect
+    output_size = (output_rect.height, output_rect.width)
+    tiles = plan_tiles(*output_size, tiling)
+    tile_w = tiles[0][2] - tiles[0][0]
+    tile_h = tiles[0][3] - tiles[0][1]
+    scale = output_scale
+    if layout_size is not None:
+        # tiles only need the resolution the layout model resizes them to
+        min_size, max_size = layout_size
+        short_side, long_side = sorted((tile_w, tile_h))
+        scale *= min(min_size / short_side, max_size / long_side, 1)
+    factor = scale / output_scale
+    shape = (len(tiles), round(tile_h * factor), round(tile_w * factor))
+    image = allocate(shape if gray else shape + (3,))
+    matrix = fitz.Matrix(scale, scale)
+    for tile_image, (x0, y0, x1, y1) in zip(image, tiles):
+        clip = fitz.Rect(x0, y0, x1, y1) * (1 / output_scale)
+        if gray:
+            pix = page.get_pixmap(
+                matrix=matrix, clip=clip, colorspace=fitz.csGRAY, alpha=False
+            )
+            samples = pixmap_to_array(pix)[:, :, 0]
+        else:
+            pix = page.get_pixmap(matrix=matrix, clip=clip, alpha=False)
+            samples = pixmap_to_array(pix)[:, :, ::-1]
+        # clip rasters may differ from the planned size by a rounding pixel
+        h, w = min(samples.shape[0], shape[1]), min(samples.shape[1], shape[2])
+        tile_image.fill(255)
+        np.copyto(tile_image[:h, :w], samples[:h, :w])
+    geometry = PageGeometry(scale, output_scale, output_size, gray, tuple(tiles))
+    return image, geometry
+
+
+def render_page(
+    page: fitz.Page,
+    dpi: int,
+    pool: Optional[PageBufferPool] = None,
+    layout_size: Optional[Tuple[int, int]] = None,
+    color_mode: str = "rgb",
+    dpi_policy: Optional[DpiPolicy] = None,
+    tiling: Optional[Tiling] = None,
+) -> RenderedPage:
+    allocate = pool.acquire if pool is not None else _allocate
+    image, geometry = render_into(
+        page, dpi, allocate, layout_size, color_mode, dpi_policy, tiling
+    )
+    return RenderedPage(image, geometry, pool)
+
+
+def _allocate(shape: Tuple[int, ...]) -> np.ndarray:
+    return np.empty(shape, dtype=np.uint8)
+
+
+def render_clip(
+    page: fitz.Page,
+    rect: Tuple[float, float, float, float],
+    scale: float,
+    gray: bool = False,
+) -> np.ndarray:
+    """Render the region `rect` (in PDF points) of `page` as a BGR or gray array."""
+    matrix = fitz.Matrix(scale, scale)
+    if gray:
+        pix = page.get_pixmap(
+            matrix=matrix, clip=fitz.Rect(rect), colorspace=fitz.csGRAY, alpha=False
+        )
+        return np.ascontiguousarray(pixmap_to_array(pix)[:, :, 0])
+    pix = page.get_pixmap(matrix=matrix, clip=fitz.Rect(rect), alpha=False)
+    return np.ascontiguousarray(pixmap_to_array(pix)[:, :, ::-1])
+
+
+class PageClipper:
+    """
+    Renders high-resolution clips of page regions from the cached document, so
+    that only regions sent to OCR or image export are rendered at full dpi.
+    """
+
+    def __init__(self, pdf_path: Union[str, bytes]):
+        self.pdf_path = pdf_path
+        self.key = document_key(pdf_path)
+
+    def clip(
+        self,
+        page_idx: int,
+        rect: Tuple[float, float, float, float],
+        scale: float,
+        gray: bool = False,
+    ) -> np.ndarray:
+        with _document_cache.checkout(self.pdf_path, self.key) as doc:
+            return render_clip(doc[page_idx], rect, scale, gray)
 
 
 def load_pdf_fitz(pdf_path, dpi=72):
     images: list[np.ndarray] = []
-    doc = fitz.open(pdf_path)
+    doc = open_pdf(pdf_path)
     for i in range(len(doc)):
-        page = doc[i]
-        pix = page.get_pixmap(matrix=fitz.Matrix(dpi / 72, dpi / 72))
-        image = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
-
-        # if width or height > 3000 pixels, don't enlarge the image
-        if pix.width > 3000 or pix.height > 3000:
-            pix = page.get_pixmap(matrix=fitz.Matrix(1, 1), alpha=False)
-            image = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
-
-        # images.append(image)
-        images.append(np.array(image)[:, :, ::-1])
+        images.append(render_page(doc[i], dpi).image)
     return images
 
 
@@ -30,6 +30,8 @@ import torch.nn.functional as F
 import torch.utils.checkpoint as checkpoint
 from timm.models.layers import drop_path, to_2tuple, trunc_normal_
 
+from .grid_cache import GridCache
+
 
 def _cfg(url="", **kwargs):
     return {
@@ -86,6 +88,73 @@ class Mlp(nn.Module):
         return x
 
 
+# relative position indices per grid and device, shared by every layer
+_relative_position_indices = GridCache()
+
+
+def relative_position_index(window_size, device=None):
+    """Pair-wise relative position index of the tokens of a grid, cls first."""
+
+    def build():
+        num_relative_distance = (2 * window_size[0] - 1) * (
+            2 * window_size[1] - 1
+        ) + 3
+        coords_h = torch.arange(window_size[0])
+        coords_w = torch.arange(window_size[1])
+        coords = torch.stack(torch.meshgrid([coords_h, coords_w]))  # 2, Wh, Ww
+        coords_flatten = torch.flatten(coords, 1)  # 2, Wh*Ww
+        relative_coords = (
+            coords_flatten[:, :, None] - coords_flatten[:, None, :]
+        )  # 2, Wh*Ww, Wh*Ww
+        relative_coords = relative_coords.permute(
+            1, 2, 0
+        ).contiguous()  # Wh*Ww, Wh*Ww, 2
+        relative_coords[:, :, 0] += window_size[0] - 1  # shift to start from 0
+        relative_coords[:, :, 1] += window_size[1] - 1
+        relative_coords[:, :, 0] *= 2 * window_size[1] - 1
+        index = torch.zeros(
+            size=(window_size[0] * window_size[1] + 1,) * 2,
+            dtype=relative_coords.dtype,
+        )
+        index[1:, 1:] = relative_coords.sum(-1)  # Wh*Ww, Wh*Ww
+        index[0, 0:] = num_relative_distance - 3
+        index[0:, 0] = num_relative_distance - 2
+        index[0, 0] = num_relative_distance - 1
+        return index.to(device)
+
+    return _relative_position_indices.get(
+        (window_size[0], window_size[1], torch.device(device or "cpu")), build
+    )
+
+
+def resize_relative_position_table(table, num_heads, window_size, new_window_size):
+    """Bicubically resize a relative position bias table to another grid."""
+    new_num_relative_distance = (2 * new_window_size[0] - 1) * (
+        2 * new_window_size[1] - 1
+    ) + 3
+    # new_num_relative_dis 为 所有可能的相对位置选项，包含cls-cls，tok-cls，与cls-tok
+    new_table = F.interpolate(
+        table[:-3, :]
+        .permute(1, 0)
+        .view(1, num_heads, 2 * window_size[0] - 1, 2 * window_size[1] - 1),
+        size=(2 * new_window_size[0] - 1, 2 * new_window_size[1] - 1),
+        mode="bicubic",
+        align_corners=False,
+    )
+    new_table = new_table.view(num_heads, new_num_relative_distance - 3).permute(1, 0)
+    return torch.cat([new_table, table[-3::]], dim=0)
+
+
+def gather_relative_position_bias(table, window_size):
+    """nH, Wh*Ww+1, Wh*Ww+1 bias of a grid from its relative position table."""
+    index = relative_position_index(window_size, table.device)
+    tokens = window_size[0] * window_size[1] + 1
+    relative_position_bias = table[index.view(-1)].view(
+        tokens, tokens, -1
+    )  # Wh*Ww,Wh*Ww,nH
+    return relative_position_bias.permute(2, 0, 1).contiguous()
+
+
 class Attention(nn.Module):
     def __init__(
         self,
@@ -159,6 +228,10 @@ class Attention(nn.Module):
         self.attn_drop = nn.Dropout(attn_drop)
         self.proj = nn.Linear(all_head_dim, dim)
         self.proj_drop = nn.Dropout(proj_drop)
+        # torch scaled_dot_product_attention instead of the explicit softmax
+        self.fused_attn = False
+        # relative position tables resized per input grid, inference only
+        self.grid_cache = GridCache()
 
     def forward(self, x, rel_pos_bias=None, training_window_size=None):
         B, N, C = x.shape
@@ -180,9 +253,7 @@ class Attention(nn.Module):
             qkv[2],
         )  # make torchscript happy (cannot use tensor as tuple)
 
-        q = q * self.scale
-        attn = q @ k.transpose(-2, -1)
-
+        bias = None
         if self.relative_position_bias_table is not None:
             if training_window_size == self.window_size:
                 relative_position_bias = self.relative_position_bias_table[
@@ -195,88 +266,51 @@ class Attention(nn.Module):
                 relative_position_bias = relative_position_bias.permute(
                     2, 0, 1
                 ).contiguous()  # nH, Wh*Ww, Wh*Ww
-                attn = attn + relative_position_bias.unsqueeze(0)
+                bias = relative_position_bias.unsqueeze(0)
             else:
                 training_window_size = tuple(training_window_size.tolist())
-                new_num_relative_distance = (2 * training_window_size[0] - 1) * (
-                    2 * training_window_size[1] - 1
-                ) + 3
-                # new_num_relative_dis 为 所有可能的相对位置选项，包含cls-cls，tok-cls，与cls-tok
-                new_relative_position_bias_table = F.interpolate(
-                    self.relative_position_bias_table[:-3, :]
-                    .permute(1, 0)
-                    .view(
-                        1,
+                # keep the resized table per grid, the gathered bias is
+                # nH x N x N for every layer
+                table = self.grid_cache.get(
+                    training_window_size,
+                    lambda: resize_relative_position_table(
+                        self.relative_position_bias_table,
                         self.num_heads,
-                        2 * self.window_size[0] - 1,
-                        2 * self.window_size[1] - 1,
+                        self.window_size,
+                        training_window_size,
                     ),
-                    size=(
-                        2 * training_window_size[0] - 1,
-                        2 * training_window_size[1] - 1,
-                    ),
-                    mode="bicubic",
-                    align_corners=False,
-                )
-                new_relative_position_bias_table = (
-                    new_relative_position_bias_table.view(
-                        self.num_heads, new_num_relative_distance - 3
-                    ).permute(1, 0)
+                    self.relative_position_bias_table,
                 )
-                new_relative_position_bias_table = torch.cat(
-                    [
-                        new_relative_position_bias_table,
-                        self.relative_position_bias_table[-3::],
-                    ],
-                    dim=0,
-                )
-
-                # get pair-wise relative position index for each token inside the window
-                coords_h = torch.arange(training_window_size[0])
-                coords_w = torch.arange(training_window_size[1])
-                coords = torch.stack(torch.meshgrid([coords_h, coords_w]))  # 2, Wh, Ww
-                coords_flatten = torch.flatten(coords, 1)  # 2, Wh*Ww
-                relative_coords = (
-                    coords_flatten[:, :, None] - coords_flatten[:, None, :]
-                )  # 2, Wh*Ww, Wh*Ww
-                relative_coords = relative_coords.permute(
-                    1, 2, 0
-                ).contiguous()  # Wh*Ww, Wh*Ww, 2
-                relative_coords[:, :, 0] += (
-                    training_window_size[0] - 1
-                )  # shift to start from 0
-                relative_coords[:, :, 1] += training_window_size[1] - 1
-                relative_coords[:, :, 0] *= 2 * training_window_size[1] - 1
-                relative_position_index = torch.zeros(
-                    size=(training_window_size[0] * training_window_size[1] + 1,) * 2,
-                    dtype=relative_coords.dtype,
-                )
-                relative_position_index[1:, 1:] = relative_coords.sum(
-                    -1
-                )  # Wh*Ww, Wh*Ww
-                relative_position_index[0, 0:] = new_num_relative_distance - 3
-                relative_position_index[0:, 0] = new_num_relative_distance - 2
-                relative_position_index[0, 0] = new_num_relative_distance - 1
-
-                relative_position_bias = new_relative_position_bias_table[
-                    relative_position_index.view(-1)
-                ].view(
-                    training_window_size[0] * training_window_size[1] + 1,
-                    training_window_size[0] * training_window_size[1] + 1,
-                    -1,
-                )  # Wh*Ww,Wh*Ww,nH
-                relative_position_bias = relative_position_bias.permute(
-                    2, 0, 1
-                ).contiguous()  # nH, Wh*Ww, Wh*Ww
-                attn = attn + relative_position_bias.unsqueeze(0)
+                relative_position_bias = gather_relative_position_bias(
+                    table, training_window_size
+                )  # nH, Wh*Ww, Wh*Ww
+                bias = relative_position_bias.unsqueeze(0)
 
         if rel_pos_bias is not None:
-            attn = attn + rel_pos_bias
-
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
-
-        x = (attn @ v).transpose(1, 2).reshape(B, N, -1)
+            bias = rel_pos_bias if bias is None else bias + rel_pos_bias
+
+        if self.fused_attn:
+            # the kernel scales by head_dim ** -0.5, self.scale may differ
+            q = q * (self.scale * q.shape[-1] ** 0.5)
+            if bias is not None:
+                bias = bias.to(q.dtype)
+            x = F.scaled_dot_product_attention(
+                q,
+                k,
+                v,
+                attn_mask=bias,
+                dropout_p=self.attn_drop.p if self.training else 0.0,
+            )
+        else:
+            q = q * self.scale
+            attn = q @ k.transpose(-2, -1)
+            if bias is not None:
+                attn = attn + bias
+            attn = attn.softmax(dim=-1)
+            attn = self.attn_drop(attn)
+            x = attn @ v
+
+        x = x.transpose(1, 2).reshape(B, N, -1)
         x = self.proj(x)
         x = self.proj_drop(x)
         return x
@@ -477,6 +511,8 @@ class RelativePositionBias(nn.Module):
         relative_position_index[0, 0] = self.num_relative_distance - 1
 
         self.register_buffer("relative_position_index", relative_position_index)
+        # resized tables per input grid, inference only
+        self.grid_cache = GridCache()
 
         # trunc_normal_(self.relative_position_bias_table, std=.02)
 
@@ -494,69 +530,21 @@ class RelativePositionBias(nn.Module):
             ).contiguous()  # nH, Wh*Ww, Wh*Ww
         else:
             training_window_size = tuple(training_window_size.tolist())
-            new_num_relative_distance = (2 * training_window_size[0] - 1) * (
-                2 * training_window_size[1] - 1
-            ) + 3
-            # new_num_relative_dis 为 所有可能的相对位置选项，包含cls-cls，tok-cls，与cls-tok
-            new_relative_position_bias_table = F.interpolate(
-                self.relative_position_bias_table[:-3, :]
-                .permute(1, 0)
-                .view(
-                    1,
+            # as in Attention only the resized table is kept, the gathered
+            # bias is nH x N x N (hundreds of MB for large pages)
+            table = self.grid_cache.get(
+                training_window_size,
+                lambda: resize_relative_position_table(
+                    self.relative_position_bias_table,
                     self.num_heads,
-                    2 * self.window_size[0] - 1,
-                    2 * self.window_size[1] - 1,
+                    self.window_size,
+                    training_window_size,
                 ),
-                size=(2 * training_window_size[0] - 1, 2 * training_window_size[1] - 1),
-                mode="bicubic",
-                align_corners=False,
-            )
-            new_relative_position_bias_table = new_relative_position_bias_table.view(
-                self.num_heads, new_num_relative_distance - 3
-            ).permute(1, 0)
-            new_relative_position_bias_table = torch.cat(
-                [
-                    new_relative_position_bias_table,
-                    self.relative_position_bias_table[-3::],
-                ],
-                dim=0,
-            )
-
-            # get pair-wise relative position index for each token inside the window
-            coords_h = torch.arange(training_window_size[0])
-            coords_w = torch.arange(training_window_size[1])
-            coords = torch.stack(torch.meshgrid([coords_h, coords_w]))  # 2, Wh, Ww
-            coords_flatten = torch.flatten(coords, 1)  # 2, Wh*Ww
-            relative_coords = (
-                coords_flatten[:, :, None] - coords_flatten[:, None, :]
-            )  # 2, Wh*Ww, Wh*Ww
-            relative_coords = relative_coords.permute(
-                1, 2, 0
-            ).contiguous()  # Wh*Ww, Wh*Ww, 2
-            relative_coords[:, :, 0] += (
-                training_window_size[0] - 1
-            )  # shift to start from 0
-            relative_coords[:, :, 1] += training_window_size[1] - 1
-            relative_coords[:, :, 0] *= 2 * training_window_size[1] - 1
-            relative_position_index = torch.zeros(
-                size=(training_window_size[0] * training_window_size[1] + 1,) * 2,
-                dtype=relative_coords.dtype,
+                self.relative_position_bias_table,
             )
-            relative_position_index[1:, 1:] = relative_coords.sum(-1)  # Wh*Ww, Wh*Ww
-            relative_position_index[0, 0:] = new_num_relative_distance - 3
-            relative_position_index[0:, 0] = new_num_relative_distance - 2
-            relative_position_index[0, 0] = new_num_relative_distance - 1
-
-            relative_position_bias = new_relative_position_bias_table[
-                relative_position_index.view(-1)
-            ].view(
-                training_window_size[0] * training_window_size[1] + 1,
-                training_window_size[0] * training_window_size[1] + 1,
-                -1,
-            )  # Wh*Ww,Wh*Ww,nH
-            relative_position_bias = relative_position_bias.permute(
-                2, 0, 1
-            ).contiguous()  # nH, Wh*Ww, Wh*Ww
+            relative_position_bias = gather_relative_position_bias(
+                table, training_window_size
+            )  # nH, Wh*Ww, Wh*Ww
 
         return relative_position_bias
 
@@ -13,6 +13,8 @@ import torch.utils.checkpoint as checkpoint
 from timm.models.layers import trunc_normal_, drop_path, to_2tuple
 from functools import partial
 
+from .grid_cache import GridCache
+
 
 def _cfg(url="", **kwargs):
     return {
@@ -298,6 +300,8 @@ class ViT(nn.Module):
             torch.zeros(1, self.num_patches + self.num_extra_tokens, self.embed_dim)
         )
         self.pos_drop = nn.Dropout(p=self.drop_rate)
+        # position embeddings interpolated per input size, inference only
+        self.grid_cache = GridCache()
 
         # self.num_extra_tokens = self.pos_embed.shape[-2] - self.num_patches
         dpr = [
@@ -432,6 +436,14 @@ class ViT(nn.Module):
         if npatch == N and w == h:
             return self.pos_embed
 
+        return self.grid_cache.get(
+            (npatch, w, h),
+            lambda: self._interpolate_pos_encoding(x, w, h),
+            self.pos_embed,
+        )
+
+    def _interpolate_pos_encoding(self, x, w, h):
+        N = self.pos_embed.shape[1] - self.num_extra_tokens
         class_ORdist_pos_embed = self.pos_embed[:, 0 : self.num_extra_tokens]
 
         patch_pos_embed = self.pos_embed[:, self.num_extra_tokens :]
@@ -0,0 +1,87 @@
+"""
+Layout detections as compact arrays. The detector's instances are filtered
+by class, score and count on the device they were computed on and copied to
+the host in one transfer.
+"""
+
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+import torch
+
+
+class LayoutDetections:
+    """
+    Detections of one page: (N, 4) float32 x0, y0, x1, y1 boxes, int64 labels
+    and float32 scores, in detector order (highest score first). The dict
+    format of earlier releases is available as `layout_dets`, or as
+    `result["layout_dets"]`.
+    """
+
+    __slots__ = ("boxes", "labels", "scores")
+
+    def __init__(self, boxes, labels, scores):
+        self.boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        self.labels = np.asarray(labels, dtype=np.int64).reshape(-1)
+        self.scores = np.asarray(scores, dtype=np.float32).reshape(-1)
+
+    @classmethod
+    def empty(cls) -> "LayoutDetections":
+        return cls(np.zeros((0, 4)), [], [])
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    def __getitem__(self, key):
+        if isinstance(key, str) and key == "layout_dets":
+            return self.layout_dets
+        return LayoutDetections(self.boxes[key], self.labels[key], self.scores[key])
+
+    @property
+    def layout_dets(self) -> List[Dict]:
+        """Detections as {"category_id", "poly", "score"} dicts."""
+        return [
+            {
+                "category_id": label,
+                "poly": [x0, y0, x1, y0, x1, y1, x0, y1],
+                "score": score,
+            }
+            for (x0, y0, x1, y1), label, score in zip(
+                self.boxes.tolist(), self.labels.tolist(), self.scores.tolist()
+            )
+        ]
+
+
+def filter_instances(
+    instances,
+    ignore_catids: Sequence[int] = (),
+    score_threshold: float = 0.0,
+    top_k: Optional[int] = None,
+) -> LayoutDetections:
+    """
+    LayoutDetections of detectron2 `instances`, dropping `ignore_catids`,
+    scores below `score_threshold` and all but the `top_k` best before the
+    copy to the host.
+    """
+    boxes = instances.pred_boxes.tensor
+    labels = instances.pred_classes
+    scores = instances.scores
+    keep = scores >= score_threshold
+    if len(ignore_catids):
+        ignore = torch.as_tensor(list(ignore_catids), device=labels.device)
+        keep &= ~torch.isin(labels, ignore)
+    index = keep.nonzero().squeeze(1)
+    if top_k is not None and index.numel() > top_k:
+        best = scores[index].topk(top_k).indices
+        index = index[best.sort().values]
+    # boxes, labels and scores in one (N, 6) block, one device-to-host copy
+    packed = torch.cat(
+        [
+            boxes[index].float(),
+            labels[index, None].float(),
+            scores[index, None].float(),
+        ],
+        dim=1,
+    )
+    packed = packed.cpu().numpy()
+    return LayoutDetections(packed[:, :4], packed[:, 4], packed[:, 5])
@@ -0,0 +1,66 @@
+"""
+Small LRU caches for tensors that only depend on the patch grid of the input
+and on the weights: interpolated position embeddings, relative position
+indices and the relative position biases gathered from them.
+"""
+
+import threading
+from collections import OrderedDict
+
+import torch
+
+GRID_CACHE_SIZE = 8  # grid sizes remembered per module
+
+
+def _state(tensor: torch.Tensor) -> tuple:
+    # in-place updates (load_state_dict, optimizer steps) bump _version,
+    # .to() / .half() give new storage
+    return (tensor.device, tensor.dtype, tensor.data_ptr(), tensor._version)
+
+
+def _tracing() -> bool:
+    # a cached tensor would be baked into traced graphs as a constant, and
+    # torch.compile cannot trace the lookup
+    compiler = getattr(torch, "compiler", None)
+    return (
+        torch.jit.is_tracing()
+        or torch.onnx.is_in_onnx_export()
+        or (compiler is not None and compiler.is_compiling())
+    )
+
+
+class GridCache:
+    """
+    LRU of tensors keyed by grid size and the state of the tensors they are
+    computed from. Entries are only stored and served with autograd disabled
+    and outside tracing, so training always recomputes and keeps its graph.
+    Safe to share between threads running forwards concurrently; a missing
+    entry may then be built more than once.
+    """
+
+    def __init__(self, maxsize: int = GRID_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, grid, build, *sources: torch.Tensor) -> torch.Tensor:
+        if self.maxsize <= 0 or torch.is_grad_enabled() or _tracing():
+            return build()
+        key = (tuple(grid),) + tuple(_state(source) for source in sources)
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                return value
+        # built outside the lock, so other grids are not held up
+        value = build()
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
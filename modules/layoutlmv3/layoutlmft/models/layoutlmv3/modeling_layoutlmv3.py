@@ -45,6 +45,8 @@ from transformers.models.roberta.modeling_roberta import (
 from transformers.utils import logging
 
 from .configuration_layoutlmv3 import LayoutLMv3Config
+from ....grid_cache import GridCache
+from ....token_pruning import prune_tokens, scatter_tokens
 from timm.models.layers import to_2tuple
 
 
@@ -69,18 +71,27 @@ class PatchEmbed(nn.Module):
         )
         self.num_patches_w = self.patch_shape[0]
         self.num_patches_h = self.patch_shape[1]
+        # interpolated position embeddings per patch grid, inference only
+        self.grid_cache = GridCache()
+
+    def interpolate_position_embedding(self, position_embedding, Hp, Wp):
+        position_embedding = position_embedding.view(
+            1, self.patch_shape[0], self.patch_shape[1], -1
+        ).permute(0, 3, 1, 2)
+        return F.interpolate(position_embedding, size=(Hp, Wp), mode="bicubic")
 
     def forward(self, x, position_embedding=None):
         x = self.proj(x)
 
         if position_embedding is not None:
             # interpolate the position embedding to the corresponding size
-            position_embedding = position_embedding.view(
-                1, self.patch_shape[0], self.patch_shape[1], -1
-            ).permute(0, 3, 1, 2)
             Hp, Wp = x.shape[2], x.shape[3]
-            position_embedding = F.interpolate(
-                position_embedding, size=(Hp, Wp), mode="bicubic"
+            position_embedding = self.grid_cache.get(
+                (Hp, Wp),
+                lambda: self.interpolate_position_embedding(
+                    position_embedding, Hp, Wp
+                ),
+                position_embedding,
             )
             x = x + position_embedding
 
@@ -300,6 +311,11 @@ class LayoutLMv3SelfAttention(nn.Module):
         self.dropout = nn.Dropout(config.attention_probs_dropout_prob)
         self.has_relative_attention_bias = config.has_relative_attention_bias
         self.has_spatial_attention_bias = config.has_spatial_attention_bias
+        # PB-Relax softmax for training stability, turned off for inference
+        self.use_cogview_attn = True
+        # torch scaled_dot_product_attention, used when no head mask or
+        # attention probabilities are requested (see runtime.py)
+        self.fused_attn = False
 
     def transpose_for_scores(self, x):
         new_x_shape = x.size()[:-1] + (
@@ -324,6 +340,33 @@ class LayoutLMv3SelfAttention(nn.Module):
         new_attention_scores = (scaled_attention_scores - max_value) * alpha
         return nn.Softmax(dim=-1)(new_attention_scores)
 
+    def fused_attention(
+        self, query_layer, key_layer, value_layer, attention_mask, rel_pos, rel_2d_pos
+    ):
+        """
+        Same result as the explicit path below with a plain softmax, without
+        materializing the attention matrix where the kernel allows it.
+        """
+        bias = None
+        if self.has_relative_attention_bias and self.has_spatial_attention_bias:
+            bias = (rel_pos + rel_2d_pos) / math.sqrt(self.attention_head_size)
+        elif self.has_relative_attention_bias:
+            bias = rel_pos / math.sqrt(self.attention_head_size)
+        if attention_mask is not None:
+            bias = attention_mask if bias is None else bias + attention_mask
+        if bias is not None:
+            bias = bias.to(query_layer.dtype)
+        context_layer = F.scaled_dot_product_attention(
+            query_layer,
+            key_layer,
+            value_layer,
+            attn_mask=bias,
+            dropout_p=self.dropout.p if self.training else 0.0,
+        )
+        context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
+        new_context_layer_shape = context_layer.size()[:-2] + (self.all_head_size,)
+        return context_layer.view(*new_context_layer_shape)
+
     def forward(
         self,
         hidden_states,
@@ -363,6 +406,17 @@ class LayoutLMv3SelfAttention(nn.Module):
 
         query_layer = self.transpose_for_scores(mixed_query_layer)
 
+        if self.fused_attn and head_mask is None and not output_attentions:
+            context_layer = self.fused_attention(
+                query_layer,
+                key_layer,
+                value_layer,
+                attention_mask,
+                rel_pos,
+                rel_2d_pos,
+            )
+            return (context_layer,)
+
         # Take the dot product between "query" and "key" to get the raw attention scores.
         # The attention scores QT K/√d could be significantly larger than input elements, and result in overflow.
         # Changing the computational order into QT(K/√d) alleviates the problem. (https://arxiv.org/pdf/2105.13290.pdf)
@@ -389,8 +443,11 @@ class LayoutLMv3SelfAttention(nn.Module):
             attention_scores = attention_scores + attention_mask
 
         # Normalize the attention scores to probabilities.
-        # attention_probs = nn.Softmax(dim=-1)(attention_scores)  # comment the line below and use this line for speedup
-        attention_probs = self.cogview_attn(attention_scores)  # to stablize training
+        if self.use_cogview_attn:
+            attention_probs = self.cogview_attn(attention_scores)  # to stablize training
+        else:
+            # same probabilities up to rounding, cogview_attn only shifts the scores
+            attention_probs = nn.functional.softmax(attention_scores, dim=-1)
         # assert torch.allclose(attention_probs, nn.Softmax(dim=-1)(attention_scores), atol=1e-8)
 
         # This is actually dropping out entire tokens to attend to, which might
@@ -696,6 +753,7 @@ class LayoutLMv3Encoder(nn.Module):
         Hp=None,
         Wp=None,
         valid_span=None,
+        pruned=None,
     ):
         all_hidden_states = () if output_hidden_states else None
         all_self_attentions = () if output_attentions else None
@@ -779,10 +837,16 @@ class LayoutLMv3Encoder(nn.Module):
                     all_cross_attentions = all_cross_attentions + (layer_outputs[2],)
 
             if self.detection and i in self.out_indices:
+                # pruned patch tokens go back into the dense grid for the FPN
+                dense_states = (
+                    hidden_states
+                    if pruned is None
+                    else scatter_tokens(hidden_states, pruned)
+                )
                 xp = (
-                    hidden_states[:, -Hp * Wp :, :]
+                    dense_states[:, -Hp * Wp :, :]
                     .permute(0, 2, 1)
-                    .reshape(len(hidden_states), -1, Hp, Wp)
+                    .reshape(hidden_states.shape[0], -1, Hp, Wp)
                 )
                 feat_out[self.out_features[j]] = self.ops[j](xp.contiguous())
                 j += 1
@@ -865,6 +929,10 @@ class LayoutLMv3Model(LayoutLMv3PreTrainedModel):
             norm_layer = partial(nn.LayerNorm, eps=1e-6)
             self.norm = norm_layer(embed_dim)
 
+        # prune_tokens options, blank patches are dropped at inference of the
+        # image-only detection backbone when set
+        self.token_pruning = None
+
         self.init_weights()
 
     def get_input_embeddings(self):
@@ -1002,7 +1070,7 @@ class LayoutLMv3Model(LayoutLMv3PreTrainedModel):
             batch_size, seq_length = input_shape
             device = inputs_embeds.device
         elif images is not None:
-            batch_size = len(images)
+            batch_size = images.shape[0]
             device = images.device
         else:
             raise ValueError(
@@ -1054,11 +1122,11 @@ class LayoutLMv3Model(LayoutLMv3PreTrainedModel):
 
         final_bbox = final_position_ids = None
         Hp = Wp = None
+        pruned = None
         if images is not None:
             patch_size = 16
-            Hp, Wp = int(images.shape[2] / patch_size), int(
-                images.shape[3] / patch_size
-            )
+            # floor division keeps the sizes symbolic when traced for export
+            Hp, Wp = images.shape[2] // patch_size, images.shape[3] // patch_size
             visual_emb = self.forward_image(images)
             if self.detection:
                 visual_attention_mask = torch.ones(
@@ -1108,6 +1176,19 @@ class LayoutLMv3Model(LayoutLMv3PreTrainedModel):
                 embedding_output = torch.cat([embedding_output, visual_emb], dim=1)
             embedding_output = self.LayerNorm(embedding_output)
             embedding_output = self.dropout(embedding_output)
+
+            if (
+                self.token_pruning is not None
+                and self.image_only
+                and final_bbox is None
+                and final_position_ids is None
+                and not self.training
+            ):
+                embedding_output, pruned_mask, pruned = prune_tokens(
+                    embedding_output, images, patch_size, **self.token_pruning
+                )
+                if pruned is not None:
+                    attention_mask = pruned_mask
         elif (
             self.config.has_relative_attention_bias
             or self.config.has_spatial_attention_bias
@@ -1139,6 +1220,7 @@ class LayoutLMv3Model(LayoutLMv3PreTrainedModel):
             Hp=Hp,
             Wp=Wp,
             valid_span=valid_span,
+            pruned=pruned,
         )
 
         if self.detection:
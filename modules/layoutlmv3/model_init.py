@@ -1,6 +1,17 @@
+import torch
 from .visualizer import Visualizer
 from .rcnn_vl import *
 from .backbone import *
+from .detections import filter_instances
+from .runtime import (
+    BACKENDS,
+    AutocastBackbone,
+    CompiledBackbone,
+    apply_inference_profile,
+    autocast_dtype,
+    enable_token_pruning,
+    profile_opts,
+)
 
 from detectron2.config import get_cfg
 from detectron2.config import CfgNode as CN
@@ -107,7 +118,36 @@ class DotDict(dict):
 
 
 class Layoutlmv3_Predictor(object):
-    def __init__(self, weights):
+    def __init__(
+        self,
+        weights,
+        profile="inference",
+        token_pruning=None,
+        backend="torch",
+        onnx=None,
+        device=None,
+        quantization=None,
+        precision="fp32",
+        compile=None,
+        postprocess=None,
+    ):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown layout backend: {backend}")
+        quantization = dict(quantization or {})
+        if backend != "torch" and quantization.get("mode", "none") != "none":
+            raise ValueError("Layout quantization applies to the torch backend")
+        if precision != "fp32" and (
+            backend != "torch" or quantization.get("mode", "none") != "none"
+        ):
+            raise ValueError(
+                f"{precision} layout precision needs the unquantized torch backend"
+            )
+        compile = dict(compile or {})
+        if backend != "torch" and compile:
+            raise ValueError("Layout compilation applies to the torch backend")
+        opts = ["MODEL.WEIGHTS", weights] + profile_opts(profile)
+        if device is not None:
+            opts += ["MODEL.DEVICE", device]
         layout_args = {
             "config_file": "modules/layoutlmv3/layoutlmv3_base_inference.yaml",
             "resume": False,
@@ -116,7 +156,7 @@ class Layoutlmv3_Predictor(object):
             "num_machines": 1,
             "machine_rank": 0,
             "dist_url": "tcp://127.0.0.1:57823",
-            "opts": ["MODEL.WEIGHTS", weights],
+            "opts": opts,
         }
         layout_args = DotDict(layout_args)
 
@@ -134,31 +174,69 @@ class Layoutlmv3_Predictor(object):
             "formula_caption",
         ]
         MetadataCatalog.get(cfg.DATASETS.TRAIN[0]).thing_classes = self.mapping
+        # score_threshold and top_k applied on device to every page's detections
+        self.postprocess = dict(postprocess or {})
         self.predictor = DefaultPredictor(cfg)
+        if profile == "inference":
+            apply_inference_profile(self.predictor.model)
+        if token_pruning is not None:
+            enable_token_pruning(self.predictor.model, **token_pruning)
+        if backend == "onnx":
+            from .onnx_backend import OnnxBackbone
+
+            # backbone and FPN on ONNX Runtime, proposals and heads stay here
+            self.predictor.model.backbone = OnnxBackbone(
+                self.predictor.model.backbone, **(onnx or {})
+            )
+        # (min, max) side the predictor resizes every page to
+        self.input_size = (cfg.INPUT.MIN_SIZE_TEST, cfg.INPUT.MAX_SIZE_TEST)
+        # model inputs are padded to multiples of this
+        self.size_divisibility = self.predictor.model.backbone.size_divisibility
+        if quantization:
+            from .quantization import quantize
+
+            # calibration runs pages through the finished predictor
+            quantize(self, **quantization)
+        dtype = autocast_dtype(precision, self.predictor.model.device.type)
+        if dtype is not None:
+            self.predictor.model.backbone = AutocastBackbone(
+                self.predictor.model.backbone, dtype
+            )
+        if compile:
+            # last, so autocast is compiled into the graph
+            self.predictor.model.backbone = CompiledBackbone(
+                self.predictor.model.backbone, **compile
+            )
+
+    def input_shape(self, height, width):
+        """(H, W) a page of the given size is resized to before padding."""
+        return self.predictor.aug.get_output_shape(height, width, *self.input_size)
 
     def __call__(self, image, ignore_catids=[]):
-        page_layout_result = {"layout_dets": []}
         outputs = self.predictor(image)
-        boxes = outputs["instances"].to("cpu")._fields["pred_boxes"].tensor.tolist()
-        labels = outputs["instances"].to("cpu")._fields["pred_classes"].tolist()
-        scores = outputs["instances"].to("cpu")._fields["scores"].tolist()
-        for bbox_idx in range(len(boxes)):
-            if labels[bbox_idx] in ignore_catids:
-                continue
-            page_layout_result["layout_dets"].append(
-                {
-                    "category_id": labels[bbox_idx],
-                    "poly": [
-                        boxes[bbox_idx][0],
-                        boxes[bbox_idx][1],
-                        boxes[bbox_idx][2],
-                        boxes[bbox_idx][1],
-                        boxes[bbox_idx][2],
-                        boxes[bbox_idx][3],
-                        boxes[bbox_idx][0],
-                        boxes[bbox_idx][3],
-                    ],
-                    "score": scores[bbox_idx],
-                }
+        return filter_instances(outputs["instances"], ignore_catids, **self.postprocess)
+
+    def batch(self, images, ignore_catids=[], pad_to=None):
+        """
+        Run several BGR images through the model in one forward pass, with
+        the same preprocessing DefaultPredictor applies to a single image.
+        `pad_to` pads the batch to a fixed (H, W) that holds every resized
+        image; detections are still in the coordinates of each input image.
+        """
+        predictor = self.predictor
+        inputs = []
+        for image in images:
+            if predictor.input_format == "RGB":
+                image = image[:, :, ::-1]
+            height, width = image.shape[:2]
+            resized = predictor.aug.get_transform(image).apply_image(image)
+            tensor = torch.as_tensor(resized.astype("float32").transpose(2, 0, 1))
+            inputs.append(
+                {"image": tensor, "height": height, "width": width, "pad_to": pad_to}
             )
-        return page_layout_result
+        with torch.no_grad():
+            outputs = predictor.model(inputs)
+        return [
+            filter_instances(out["instances"], ignore_catids, **self.postprocess)
+            for out in outputs
+        ]
@@ -0,0 +1,118 @@
+"""
+ONNX Runtime execution of the detector's backbone and FPN. The graph is
+exported by tools/export_onnx.py with dynamic batch and image sizes and split
+at the FPN feature maps: region proposals, ROI heads and postprocessing stay
+in PyTorch and run on the features the session returns.
+"""
+
+import inspect
+from typing import Dict, List, Optional, Sequence
+
+import torch
+from torch import nn
+
+INPUT_NAME = "images"
+
+
+class BackboneGraph(nn.Module):
+    """The backbone and FPN as a tensor in, tuple of feature maps out module."""
+
+    def __init__(self, backbone: nn.Module):
+        super().__init__()
+        self.backbone = backbone
+        self.output_names: List[str] = list(backbone._out_features)
+
+    def forward(self, images: torch.Tensor):
+        features = self.backbone({"images": images})
+        return tuple(features[name] for name in self.output_names)
+
+
+def export_backbone(
+    backbone: nn.Module,
+    path: str,
+    height: int = 800,
+    width: int = 608,
+    batch_size: int = 1,
+    opset: int = 17,
+) -> List[str]:
+    """
+    Export the backbone and FPN of a built detector to `path`. The sample
+    input only fixes the trace, batch size and image size stay dynamic.
+    Returns the feature names, which are the graph's output names.
+    """
+    graph = BackboneGraph(backbone).eval()
+    param = next(backbone.parameters())
+    images = torch.zeros(
+        batch_size, 3, height, width, device=param.device, dtype=param.dtype
+    )
+    dynamic_axes = {INPUT_NAME: {0: "batch", 2: "height", 3: "width"}}
+    for name in graph.output_names:
+        dynamic_axes[name] = {0: "batch", 2: f"{name}_height", 3: f"{name}_width"}
+    kwargs = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        # the TorchScript tracer, input sizes flow through traced shape ops
+        kwargs["dynamo"] = False
+    with torch.no_grad():
+        torch.onnx.export(
+            graph,
+            (images,),
+            path,
+            input_names=[INPUT_NAME],
+            output_names=graph.output_names,
+            dynamic_axes=dynamic_axes,
+            opset_version=opset,
+            do_constant_folding=True,
+            **kwargs,
+        )
+    return graph.output_names
+
+
+class OnnxBackbone(nn.Module):
+    """
+    Drop-in replacement for `model.backbone` that runs an exported graph on
+    ONNX Runtime. The shape metadata the rest of the detector reads is taken
+    from the PyTorch backbone it replaces.
+    """
+
+    def __init__(
+        self,
+        backbone: nn.Module,
+        path: str,
+        intra_op_threads: int = 0,
+        inter_op_threads: int = 1,
+        providers: Sequence[str] = ("CPUExecutionProvider",),
+        optimized_path: Optional[str] = None,
+    ):
+        super().__init__()
+        import onnxruntime as ort  # only needed for this backend
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        # 0 lets ONNX Runtime use one thread per physical core
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        if inter_op_threads > 1:
+            options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+        if optimized_path:
+            # save the optimized graph, later sessions can load it directly
+            options.optimized_model_filepath = optimized_path
+        self.session = ort.InferenceSession(path, options, providers=list(providers))
+        self.output_names = [output.name for output in self.session.get_outputs()]
+        self.size_divisibility = backbone.size_divisibility
+        self.padding_constraints = getattr(backbone, "padding_constraints", {})
+        self._out_features = list(backbone._out_features)
+        self._output_shape = backbone.output_shape()
+
+    def output_shape(self):
+        return self._output_shape
+
+    def forward(self, x: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+        images = x["images"]
+        outputs = self.session.run(
+            self.output_names,
+            {INPUT_NAME: images.detach().float().cpu().numpy()},
+        )
+        return {
+            name: torch.from_numpy(output).to(images.device)
+            for name, output in zip(self.output_names, outputs)
+        }
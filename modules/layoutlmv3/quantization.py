@@ -0,0 +1,141 @@
+"""
+INT8 builds of the layout detector for CPU inference. "int8_dynamic" stores
+the Linear layers of the LayoutLMv3 encoder as int8 and quantizes their
+activations on the fly; the 1x1 and 3x3 convolutions of the FPN can in
+addition be quantized statically, with activation ranges calibrated on
+rendered pages.
+"""
+
+import glob
+from typing import Iterator, List, Optional, Sequence
+
+import cv2
+import numpy as np
+import torch
+from torch import nn
+from torch.ao import quantization as tq
+
+from ..extract_pdf import open_pdf, render_page
+from .layoutlmft.models.layoutlmv3.modeling_layoutlmv3 import LayoutLMv3Encoder
+
+QUANTIZATION = ("none", "int8_dynamic")
+
+
+def quantize_encoder_dynamic(model: nn.Module) -> nn.Module:
+    """int8 weights and dynamically quantized inputs for encoder Linear layers."""
+    for module in model.modules():
+        if isinstance(module, LayoutLMv3Encoder):
+            tq.quantize_dynamic(
+                module.layer, {nn.Linear}, dtype=torch.qint8, inplace=True
+            )
+    return model
+
+
+class QuantizedConv(nn.Module):
+    """A float-in, float-out convolution that runs quantized once converted."""
+
+    def __init__(self, conv: nn.Conv2d):
+        super().__init__()
+        self.quant = tq.QuantStub()
+        # a plain Conv2d, detectron2's subclass is not in the conversion mappings
+        self.conv = nn.Conv2d(
+            conv.in_channels,
+            conv.out_channels,
+            conv.kernel_size,
+            stride=conv.stride,
+            padding=conv.padding,
+            dilation=conv.dilation,
+            groups=conv.groups,
+            bias=conv.bias is not None,
+        )
+        self.conv.load_state_dict(conv.state_dict(), strict=False)
+        self.dequant = tq.DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.conv(self.quant(x)))
+
+
+def prepare_fpn_static(fpn: nn.Module, engine: str = "x86") -> List[QuantizedConv]:
+    """
+    Swap the lateral and output convolutions of a detectron2 FPN for
+    QuantizedConv modules with observers. Run calibration pages through the
+    model, then pass the returned modules to `convert_fpn_static`.
+    """
+    torch.backends.quantized.engine = engine
+    qconfig = tq.get_default_qconfig(engine)
+    names = {id(module): name for name, module in fpn.named_children()}
+    wrapped = []
+    for convs in (fpn.lateral_convs, fpn.output_convs):
+        for idx, conv in enumerate(convs):
+            if getattr(conv, "norm", None) is not None or getattr(
+                conv, "activation", None
+            ):
+                continue
+            module = QuantizedConv(conv)
+            module.qconfig = qconfig
+            tq.prepare(module, inplace=True)
+            setattr(fpn, names[id(conv)], module)
+            convs[idx] = module
+            wrapped.append(module)
+    return wrapped
+
+
+def convert_fpn_static(modules: Sequence[QuantizedConv]):
+    for module in modules:
+        tq.convert(module, inplace=True)
+
+
+def calibration_images(
+    paths: Sequence[str], dpi: int = 200, limit: int = 32
+) -> Iterator[np.ndarray]:
+    """Up to `limit` BGR pages from PDF files and images, globs allowed."""
+    count = 0
+    for pattern in paths:
+        for path in sorted(glob.glob(pattern)) or [pattern]:
+            if path.lower().endswith(".pdf"):
+                doc = open_pdf(path)
+                try:
+                    for page in doc:
+                        if count >= limit:
+                            return
+                        yield render_page(page, dpi).image
+                        count += 1
+                finally:
+                    doc.close()
+            else:
+                if count >= limit:
+                    return
+                image = cv2.imread(path)
+                if image is not None:
+                    yield image
+                    count += 1
+
+
+def quantize(
+    predictor,
+    mode: str = "none",
+    fpn_calibration: Optional[Sequence[str]] = None,
+    calibration_pages: int = 32,
+    calibration_dpi: int = 200,
+):
+    """
+    Quantize the model of a Layoutlmv3_Predictor in place. With
+    `fpn_calibration` files, the FPN convolutions are statically quantized
+    after running up to `calibration_pages` of them through the model.
+    """
+    if mode not in QUANTIZATION:
+        raise ValueError(f"Unknown layout quantization: {mode}")
+    if mode == "none":
+        return predictor
+    model = predictor.predictor.model
+    if model.device.type != "cpu":
+        raise ValueError(f"{mode} quantization runs on CPU, not {model.device}")
+    quantize_encoder_dynamic(model)
+    if fpn_calibration:
+        modules = prepare_fpn_static(model.backbone)
+        for image in calibration_images(
+            fpn_calibration, calibration_dpi, calibration_pages
+        ):
+            predictor(image)
+        convert_fpn_static(modules)
+    return predictor
@@ -4,6 +4,7 @@ import numpy as np
 from typing import Dict, List, Optional, Tuple
 import torch
 from torch import nn
+from torch.nn import functional as F
 
 from detectron2.config import configurable
 from detectron2.structures import ImageList, Instances
@@ -139,6 +140,24 @@ class VLGeneralizedRCNN(GeneralizedRCNN):
         else:
             return results
 
+    def preprocess_image(self, batched_inputs: List[Dict[str, torch.Tensor]]):
+        """
+        Normalize, pad and batch the input images. Inputs may carry a
+        "pad_to" (H, W) bucket, which the whole batch is padded to so that
+        repeated calls see the same shapes; image_sizes keep the real extents,
+        so proposals and postprocessing ignore the extra padding.
+        """
+        images = super().preprocess_image(batched_inputs)
+        pad_to = batched_inputs[0].get("pad_to")
+        if pad_to is not None:
+            height, width = images.tensor.shape[-2:]
+            assert pad_to[0] >= height and pad_to[1] >= width, (pad_to, height, width)
+            # zero is the pixel mean after normalization, as in ImageList
+            images.tensor = F.pad(
+                images.tensor, (0, pad_to[1] - width, 0, pad_to[0] - height)
+            )
+        return images
+
     def get_batch(self, examples, images):
         if len(examples) >= 1 and "bbox" not in examples[0]:  # image_only
             return {"images": images.tensor}
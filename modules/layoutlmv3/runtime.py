@@ -0,0 +1,218 @@
+"""
+Inference-time builds of the layout detector. The "reference" profile is the
+model exactly as configured for training; the "inference" profile strips what
+only matters there and folds eval-mode modules together.
+"""
+
+import logging
+import os
+
+import torch
+from log import loggers
+from torch import nn
+from torch.nn import functional as F
+from typing import Optional
+
+from .beit import Attention as BeitAttention
+from .layoutlmft.models.layoutlmv3.modeling_layoutlmv3 import (
+    LayoutLMv3Encoder,
+    LayoutLMv3Model,
+    LayoutLMv3SelfAttention,
+)
+
+logger = loggers("layout", level=logging.INFO)
+
+PROFILES = ("reference", "inference")
+# torch, or onnx: backbone and FPN exported by tools/export_onnx.py
+BACKENDS = ("torch", "onnx")
+# memory-efficient and flash attention kernels, torch >= 2.0
+FUSED_ATTN = hasattr(F, "scaled_dot_product_attention")
+PRECISIONS = {"fp32": torch.float32, "fp16": torch.float16, "bf16": torch.bfloat16}
+
+
+def profile_opts(profile: str) -> list:
+    """Config overrides applied before the model is built."""
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown layout profile: {profile}")
+    if profile == "inference":
+        # the parser only reads boxes, the mask head's output was discarded
+        return ["MODEL.MASK_ON", False]
+    return []
+
+
+@torch.no_grad()
+def fuse_conv_transpose_bn(
+    conv: nn.ConvTranspose2d, bn: nn.BatchNorm2d
+) -> nn.ConvTranspose2d:
+    """Fold an eval-mode BatchNorm into the transposed convolution before it."""
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    fused = nn.ConvTranspose2d(
+        conv.in_channels,
+        conv.out_channels,
+        conv.kernel_size,
+        stride=conv.stride,
+        padding=conv.padding,
+        output_padding=conv.output_padding,
+        groups=conv.groups,
+        bias=True,
+        dilation=conv.dilation,
+    ).to(conv.weight.device, conv.weight.dtype)
+    # ConvTranspose2d weights are (in, out // groups, kh, kw)
+    fused.weight.copy_(conv.weight * scale.reshape(1, -1, 1, 1))
+    bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+    fused.bias.copy_((bias - bn.running_mean) * scale + bn.bias)
+    return fused
+
+
+def apply_inference_profile(model: nn.Module) -> nn.Module:
+    """
+    Switch a built detector to eval mode, plain softmax (fused where torch
+    provides scaled_dot_product_attention) and no gradient checkpointing, and
+    fuse the BatchNorm of the stride-4 FPN branch.
+    """
+    model.eval()
+    for module in model.modules():
+        if isinstance(module, LayoutLMv3SelfAttention):
+            module.use_cogview_attn = False
+            module.fused_attn = FUSED_ATTN
+        elif isinstance(module, BeitAttention):
+            module.fused_attn = FUSED_ATTN
+        elif isinstance(module, LayoutLMv3Encoder):
+            module.gradient_checkpointing = False
+            if module.detection and isinstance(module.fpn1[1], nn.BatchNorm2d):
+                # fpn1 is ConvTranspose2d, BatchNorm2d, GELU, ConvTranspose2d
+                module.fpn1[0] = fuse_conv_transpose_bn(module.fpn1[0], module.fpn1[1])
+                module.fpn1[1] = nn.Identity()
+    for param in model.parameters():
+        param.requires_grad_(False)
+    return model
+
+
+def enable_token_pruning(
+    model: nn.Module, tolerance: float = 0.04, margin: int = 1
+) -> nn.Module:
+    """
+    Drop blank page patches in the image-only LayoutLMv3 backbone at
+    inference. `tolerance` is the per-channel pixel range of a blank patch in
+    normalized units, `margin` the patches kept around content.
+    """
+    for module in model.modules():
+        if isinstance(module, LayoutLMv3Model) and module.image_only:
+            module.token_pruning = {"tolerance": tolerance, "margin": margin}
+    return model
+
+
+def bf16_supported(device_type: str) -> bool:
+    if device_type == "cuda":
+        return torch.cuda.is_bf16_supported()
+    # native bf16 instructions, emulated bf16 is slower than fp32
+    return torch.ops.mkldnn._is_mkldnn_bf16_supported()
+
+
+def autocast_dtype(precision: str, device_type: str) -> Optional[torch.dtype]:
+    """The autocast dtype for a precision setting, None to run in fp32."""
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown layout precision: {precision}")
+    if precision == "fp32":
+        return None
+    if precision == "fp16" and device_type != "cuda":
+        raise ValueError("fp16 layout inference needs CUDA, use bf16 on CPU")
+    if precision == "bf16" and not bf16_supported(device_type):
+        logger.warning(f"bf16 is not supported on this {device_type}, using fp32")
+        return None
+    return PRECISIONS[precision]
+
+
+class AutocastBackbone(nn.Module):
+    """
+    Runs the backbone and FPN under autocast and hands fp32 feature maps to
+    the RPN and ROI heads, so box regression, classification softmax and NMS
+    stay in fp32. Inside the backbone, autocast keeps softmax and LayerNorm
+    in fp32.
+    """
+
+    def __init__(self, backbone: nn.Module, dtype: torch.dtype):
+        super().__init__()
+        self.backbone = backbone
+        self.dtype = dtype
+        self.size_divisibility = backbone.size_divisibility
+        self.padding_constraints = getattr(backbone, "padding_constraints", {})
+        self._out_features = list(backbone._out_features)
+
+    def output_shape(self):
+        return self.backbone.output_shape()
+
+    def forward(self, x):
+        images = x["images"]
+        with torch.autocast(images.device.type, dtype=self.dtype):
+            features = self.backbone(x)
+        return {name: feature.float() for name, feature in features.items()}
+
+
+class CompiledBackbone(nn.Module):
+    """
+    Runs the backbone and FPN through torch.compile. Inductor's compiled
+    graphs and kernels are cached under `cache_dir`, so later process starts
+    reuse them instead of recompiling. With `dynamic=False` every input size
+    compiles separately, which suits bucketed inputs; the batch dimension is
+    marked dynamic, so each size needs one graph for single images and one
+    for batches. Shapes past `recompile_limit` graphs run eagerly. If
+    compilation or a compiled call fails, the backbone falls back to eager
+    mode for good.
+    """
+
+    def __init__(
+        self,
+        backbone: nn.Module,
+        mode: str = "default",
+        dynamic: Optional[bool] = False,
+        cache_dir: Optional[str] = None,
+        recompile_limit: Optional[int] = None,
+    ):
+        super().__init__()
+        self.backbone = backbone
+        self.size_divisibility = backbone.size_divisibility
+        self.padding_constraints = getattr(backbone, "padding_constraints", {})
+        self._out_features = list(backbone._out_features)
+        self._compiled = None
+        if not hasattr(torch, "compile"):
+            logger.warning("torch.compile needs torch >= 2.0, running eager")
+            return
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            # read by inductor when it first compiles, an explicit env wins
+            os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.abspath(cache_dir))
+            from torch._inductor import config as inductor_config
+
+            inductor_config.fx_graph_cache = True
+        if recompile_limit:
+            from torch._dynamo import config as dynamo_config
+
+            # renamed from cache_size_limit in later torch releases
+            name = (
+                "recompile_limit"
+                if hasattr(dynamo_config, "recompile_limit")
+                else "cache_size_limit"
+            )
+            setattr(
+                dynamo_config, name, max(getattr(dynamo_config, name), recompile_limit)
+            )
+        # compile the bound forward, so the compiled wrapper is not registered
+        # as a second copy of the backbone's parameters
+        self._compiled = torch.compile(backbone.forward, mode=mode, dynamic=dynamic)
+
+    def output_shape(self):
+        return self.backbone.output_shape()
+
+    def forward(self, x):
+        if self._compiled is not None:
+            mark_dynamic = getattr(torch._dynamo, "maybe_mark_dynamic", None)
+            if mark_dynamic is not None:
+                # partial batches would otherwise compile once per batch size
+                mark_dynamic(x["images"], 0)
+            try:
+                return self._compiled(x)
+            except Exception as e:
+                logger.warning(f"compiled layout backbone failed, running eager: {e}")
+                self._compiled = None
+        return self.backbone(x)
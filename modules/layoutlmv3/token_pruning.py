@@ -0,0 +1,93 @@
+"""
+Pruning of blank page patches for the image-only LayoutLMv3 backbone. Patches
+whose pixels are near-uniform and that lie at least `margin` patches away from
+any other content are dropped before the encoder. The encoder outputs are
+scattered back into the dense patch grid before the FPN, with dropped patches
+taking the mean feature of the blank patches kept at content margins.
+"""
+
+from typing import NamedTuple, Optional, Tuple
+
+import torch
+from torch.nn import functional as F
+
+
+class PrunedTokens(NamedTuple):
+    # (B, K) positions in the dense sequence (cls first); padding entries of
+    # shorter rows point one past the end
+    index: torch.Tensor
+    # (B, K) False for padding entries
+    valid: torch.Tensor
+    # (B, K) kept tokens that are blank patches themselves
+    blank: torch.Tensor
+    # length of the dense sequence
+    length: int
+
+
+def blank_patches(
+    images: torch.Tensor, patch_size: int = 16, tolerance: float = 0.04
+) -> torch.Tensor:
+    """
+    (B, Hp, Wp) mask of patches whose per-channel range is within `tolerance`,
+    in the normalized units the model sees.
+    """
+    high = F.max_pool2d(images, patch_size)
+    low = -F.max_pool2d(-images, patch_size)
+    return (high - low).amax(1) <= tolerance
+
+
+def prune_tokens(
+    embeddings: torch.Tensor,
+    images: torch.Tensor,
+    patch_size: int = 16,
+    tolerance: float = 0.04,
+    margin: int = 1,
+) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[PrunedTokens]]:
+    """
+    Drop the blank patch tokens of (B, 1 + Hp*Wp, C) embeddings. Returns the
+    pruned embeddings, their (B, K) attention mask and the PrunedTokens to
+    scatter encoder outputs back with; without anything to drop, the
+    embeddings are returned unchanged with None for both.
+    """
+    blank = blank_patches(images, patch_size, tolerance)
+    content = (~blank).to(images.dtype).unsqueeze(1)
+    near_content = (
+        F.max_pool2d(content, 2 * margin + 1, stride=1, padding=margin)[:, 0] > 0
+    )
+    drop = (blank & ~near_content).flatten(1)
+    if not drop.any():
+        return embeddings, None, None
+
+    batch_size, length, _ = embeddings.shape
+    keep = torch.cat([drop.new_ones((batch_size, 1)), ~drop], dim=1)
+    counts = keep.sum(1)
+    tokens = int(counts.max())
+    # kept positions first, in sequence order
+    order = torch.sort((~keep).to(torch.uint8), dim=1, stable=True).indices
+    index = order[:, :tokens]
+    valid = torch.arange(tokens, device=index.device) < counts[:, None]
+    index = torch.where(valid, index, torch.full_like(index, length))
+    blank = torch.cat([blank.new_zeros((batch_size, 1)), blank.flatten(1)], dim=1)
+    kept_blank = torch.gather(blank, 1, index.clamp(max=length - 1)) & valid
+
+    pruned = torch.gather(
+        embeddings,
+        1,
+        index.clamp(max=length - 1).unsqueeze(-1).expand(-1, -1, embeddings.shape[-1]),
+    )
+    return pruned, valid.long(), PrunedTokens(index, valid, kept_blank, length)
+
+
+def scatter_tokens(hidden_states: torch.Tensor, pruned: PrunedTokens) -> torch.Tensor:
+    """Dense (B, length, C) hidden states from the kept tokens."""
+    batch_size, _, channels = hidden_states.shape
+    weights = pruned.blank.to(hidden_states.dtype).unsqueeze(-1)
+    fill = (hidden_states * weights).sum(1, keepdim=True) / weights.sum(
+        1, keepdim=True
+    ).clamp(min=1)
+    # one spare slot takes the padding entries
+    dense = fill.expand(batch_size, pruned.length + 1, channels).contiguous()
+    dense = dense.scatter(
+        1, pruned.index.unsqueeze(-1).expand(-1, -1, channels), hidden_states
+    )
+    return dense[:, : pruned.length]
@@ -0,0 +1,263 @@
+import asyncio
+import multiprocessing
+import numpy as np
+from collections import deque
+from functools import partial
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from typing import AsyncIterator, List, NamedTuple, Optional, Tuple, Union
+from .extract_pdf import (
+    DpiPolicy,
+    PageBufferPool,
+    PageGeometry,
+    RenderedPage,
+    configure_document_cache,
+    document_key,
+    get_document_cache,
+    render_into,
+)
+from .tiling import Tiling
+
+
+class SharedRenderedPage(RenderedPage):
+    """A page rendered by a worker process into a shared memory block."""
+
+    def __init__(self, name: str, shape: Tuple[int, ...], geometry: PageGeometry):
+        self._shm = SharedMemory(name=name)
+        super().__init__(
+            np.ndarray(shape, dtype=np.uint8, buffer=self._shm.buf),
+            PageGeometry(*geometry),
+        )
+
+    def release(self):
+        if self._shm is None:
+            return
+        self.image = None
+        self._shm.close()
+        self._shm.unlink()
+        self._shm = None
+
+
+class SharedSource(NamedTuple):
+    """An in-memory PDF placed once in a shared memory block for the workers."""
+
+    name: str
+    size: int
+
+    def read(self) -> bytes:
+        shm = SharedMemory(name=self.name)
+        try:
+            return bytes(shm.buf[: self.size])
+        finally:
+            shm.close()
+
+
+def _share_bytes(source: Union[bytes, bytearray, memoryview]) -> SharedMemory:
+    data = memoryview(source).cast("B")
+    shm = SharedMemory(create=True, size=max(len(data), 1))
+    shm.buf[: len(data)] = data
+    return shm
+
+
+def _render_range(
+    source: Union[str, SharedSource],
+    key: Tuple,
+    start: int,
+    stop: int,
+    dpi: int,
+    layout_size: Optional[Tuple[int, int]] = None,
+    color_mode: str = "rgb",
+    dpi_policy: Optional[DpiPolicy] = None,
+    tiling: Optional[Tiling] = None,
+) -> List[Tuple[str, Tuple[int, ...], PageGeometry]]:
+    """Worker side: render pages [start, stop) into new shared memory blocks."""
+    blocks = []
+
+    def allocate(shape):
+        shm = SharedMemory(create=True, size=int(np.prod(shape)))
+        # ownership passes to the parent, which unlinks the block after use
+        resource_tracker.unregister(shm._name, "shared_memory")
+        blocks.append(shm)
+        return np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+
+    pages = []
+    cache = get_document_cache()
+    if isinstance(source, SharedSource) and key not in cache:
+        # only the first range of a document on this worker reads its bytes
+        source = source.read()
+    try:
+        with cache.checkout(source, key) as doc:
+            for page_idx in range(start, stop):
+                image, geometry = render_into(
+                    doc[page_idx],
+                    dpi,
+                    allocate,
+                    layout_size,
+                    color_mode,
+                    dpi_policy,
+                    tiling,
+                )
+                pages.append((blocks[-1].name, image.shape, geometry))
+                del image
+    except BaseException:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+        raise
+    for shm in blocks:
+        shm.close()
+    return pages
+
+
+def _discard_blocks(future: Future):
+    if future.cancelled() or future.exception() is not None:
+        return
+    for block in future.result():
+        SharedRenderedPage(*block).release()
+
+
+class RenderService:
+    """
+    Renders PDF pages on a pool of worker processes. MuPDF holds the GIL for
+    most of its work, so thread-based rendering of one document stays on one
+    core. Each worker opens the document and renders a page range into shared
+    memory, which the parser maps without copying or pickling the pixels.
+    In-memory documents are likewise placed in shared memory once, instead of
+    being pickled into every page range.
+    With `workers: 0` pages are rendered on the calling thread pool instead.
+    """
+
+    def __init__(
+        self,
+        workers: int = 4,
+        pages_per_task: int = 4,
+        color_mode: str = "rgb",
+        adaptive_dpi: Optional[dict] = None,
+        tiling: Optional[dict] = None,
+        document_cache: Optional[dict] = None,
+        executor: Optional[Executor] = None,
+    ):
+        if color_mode not in ("rgb", "gray", "auto"):
+            raise ValueError(f"Unsupported color mode: {color_mode}")
+        self.workers = workers
+        self.pages_per_task = max(1, pages_per_task)
+        self.color_mode = color_mode
+        adaptive_dpi = dict(adaptive_dpi or {})
+        self.dpi_policy = (
+            DpiPolicy(**adaptive_dpi) if adaptive_dpi.pop("enabled", False) else None
+        )
+        tiling = dict(tiling or {})
+        # batch_size is read by the parser, which runs layout on the tiles
+        tiling.pop("batch_size", None)
+        self.tiling = Tiling(**tiling) if tiling.pop("enabled", False) else None
+        self.page_pool = PageBufferPool()
+        # open documents are cached per process, in the parser and each worker
+        document_cache = dict(document_cache or {})
+        configure_document_cache(**document_cache)
+        if executor is None and workers > 0:
+            executor = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=partial(configure_document_cache, **document_cache),
+            )
+        self._executor = executor
+
+    async def render(
+        self,
+        source: Union[str, bytes],
+        dpi: int,
+        total_page: int,
+        thread_pool: Optional[Executor] = None,
+        layout_size: Optional[Tuple[int, int]] = None,
+        first_page: int = 0,
+    ) -> AsyncIterator[RenderedPage]:
+        """
+        Yield pages [first_page, total_page) in order; callers must release
+        each page.
+        """
+        if self._executor is None:
+            async for page in self._render_threaded(
+                source, dpi, first_page, total_page, thread_pool, layout_size
+            ):
+                yield page
+            return
+
+        # keyed once here rather than hashing in-memory documents per task
+        key = await asyncio.get_event_loop().run_in_executor(
+            thread_pool, document_key, source
+        )
+        ranges = deque(
+            (start, min(start + self.pages_per_task, total_page))
+            for start in range(first_page, total_page, self.pages_per_task)
+        )
+        # bound the pages held in shared memory ahead of the consumer
+        window = 2 * self.workers
+        in_flight: deque = deque()
+        ready: deque = deque()
+        shared = None
+
+        def submit():
+            while ranges and len(in_flight) < window:
+                start, stop = ranges.popleft()
+                in_flight.append(
+                    self._executor.submit(
+                        _render_range,
+                        source,
+                        key,
+                        start,
+                        stop,
+                        dpi,
+                        layout_size,
+                        self.color_mode,
+                        self.dpi_policy,
+                        self.tiling,
+                    )
+                )
+
+        try:
+            if isinstance(source, (bytes, bytearray, memoryview)):
+                # workers get the block's name, not a pickled copy per range
+                shared = _share_bytes(source)
+                source = SharedSource(shared.name, memoryview(source).nbytes)
+            submit()
+            while in_flight:
+                # popped once done, a cancelled wait leaves it to the finally
+                blocks = await asyncio.wrap_future(in_flight[0])
+                in_flight.popleft()
+                submit()
+                ready.extend(SharedRenderedPage(*block) for block in blocks)
+                while ready:
+                    yield ready.popleft()
+        finally:
+            for page in ready:
+                page.release()
+            # ranges already rendering are unlinked once they complete
+            for future in in_flight:
+                if not future.cancel():
+                    future.add_done_callback(_discard_blocks)
+            if shared is not None:
+                shared.close()
+                shared.unlink()
+
+    async def _render_threaded(
+        self, source, dpi, first_page, total_page, thread_pool, layout_size
+    ):
+        loop = asyncio.get_event_loop()
+        key = await loop.run_in_executor(thread_pool, document_key, source)
+
+        def render(page_idx):
+            with get_document_cache().checkout(source, key) as doc:
+                return render_into(
+                    doc[page_idx],
+                    dpi,
+                    self.page_pool.acquire,
+                    layout_size,
+                    self.color_mode,
+                    self.dpi_policy,
+                    self.tiling,
+                )
+
+        for page_idx in range(first_page, total_page):
+            image, geometry = await loop.run_in_executor(thread_pool, render, page_idx)
+            yield RenderedPage(image, geometry, self.page_pool)
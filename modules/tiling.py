@@ -0,0 +1,97 @@
+from typing import Dict, List, NamedTuple, Sequence, Tuple
+
+Box = Tuple[int, int, int, int]
+
+
+class Tiling(NamedTuple):
+    # side of a square tile in output pixels
+    tile_size: int = 2048
+    # pixels shared by neighbouring tiles, so most regions fit whole in one
+    overlap: int = 256
+
+
+def _starts(length: int, tile: int, step: int) -> List[int]:
+    if length <= tile:
+        return [0]
+    starts = list(range(0, length - tile, step))
+    # the last tile is aligned to the page edge, so all tiles have one size
+    starts.append(length - tile)
+    return starts
+
+
+def plan_tiles(height: int, width: int, tiling: Tiling) -> List[Box]:
+    """Overlapping (x0, y0, x1, y1) tiles covering a height x width page."""
+    step = max(tiling.tile_size - tiling.overlap, 1)
+    tile_h = min(tiling.tile_size, height)
+    tile_w = min(tiling.tile_size, width)
+    return [
+        (x, y, x + tile_w, y + tile_h)
+        for y in _starts(height, tile_h, step)
+        for x in _starts(width, tile_w, step)
+    ]
+
+
+def _cut_sides(bbox: Sequence[float], tile: Box, page_size: Tuple[int, int], tol):
+    """Sides of `bbox` lying on a tile edge inside the page, i.e. truncated."""
+    height, width = page_size
+    x0, y0, x1, y1 = tile
+    return (
+        (x0 > 0 and bbox[0] - x0 <= tol)
+        or (y0 > 0 and bbox[1] - y0 <= tol)
+        or (x1 < width and x1 - bbox[2] <= tol)
+        or (y1 < height and y1 - bbox[3] <= tol)
+    )
+
+
+def _overlap(a: Sequence[float], b: Sequence[float]) -> Tuple[float, float]:
+    """Intersection area of a and b, and that area relative to the smaller box."""
+    w = min(a[2], b[2]) - max(a[0], b[0])
+    h = min(a[3], b[3]) - max(a[1], b[1])
+    if w <= 0 or h <= 0:
+        return 0.0, 0.0
+    area = w * h
+    small = min((a[2] - a[0]) * (a[3] - a[1]), (b[2] - b[0]) * (b[3] - b[1]))
+    return area, area / small if small > 0 else 0.0
+
+
+def merge_tile_detections(
+    detections: List[Dict],
+    page_size: Tuple[int, int],
+    containment: float = 0.5,
+    edge_tolerance: int = 4,
+) -> Tuple[List[Tuple[float, float, float, float]], List[int], List[float]]:
+    """
+    Merge per-tile detections, given as dicts with "category_id", "score",
+    "tile" and a global "bbox", into page-level boxes, labels and scores,
+    highest score first.
+
+    Duplicates of a region seen whole by two tiles are dropped, and fragments
+    of a region cut by a seam are joined into their union box.
+    """
+    merged = []
+    for det in sorted(detections, key=lambda d: d["score"], reverse=True):
+        det = dict(
+            det,
+            cut=_cut_sides(det["bbox"], det["tile"], page_size, edge_tolerance),
+        )
+        for kept in merged:
+            if kept["category_id"] != det["category_id"]:
+                continue
+            area, ratio = _overlap(kept["bbox"], det["bbox"])
+            if ratio >= containment or (area > 0 and (kept["cut"] or det["cut"])):
+                kept["bbox"] = (
+                    min(kept["bbox"][0], det["bbox"][0]),
+                    min(kept["bbox"][1], det["bbox"][1]),
+                    max(kept["bbox"][2], det["bbox"][2]),
+                    max(kept["bbox"][3], det["bbox"][3]),
+                )
+                kept["cut"] = kept["cut"] or det["cut"]
+                break
+        else:
+            merged.append(det)
+
+    return (
+        [det["bbox"] for det in merged],
+        [det["category_id"] for det in merged],
+        [det["score"] for det in merged],
+    )
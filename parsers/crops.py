@@ -0,0 +1,82 @@
+import asyncio
+import hashlib
+import threading
+import numpy as np
+from PIL import Image
+from collections import OrderedDict
+from typing import Optional, Tuple
+from .encoder import ImageEncoder
+
+
+def _encoder_signature(encoder: ImageEncoder) -> bytes:
+    return (
+        f"{encoder.format}:{encoder.quality}:"
+        f"{encoder.png_compress_level}:{encoder.max_dimension}"
+    ).encode()
+
+
+def perceptual_hash(image: Image.Image) -> bytes:
+    """64-bit difference hash; near-identical crops share the same value."""
+    small = np.asarray(image.convert("L").resize((9, 8), Image.BILINEAR))
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return np.packbits(bits).tobytes()
+
+
+def crop_name(image: Image.Image, encoder: ImageEncoder, naming: str) -> str:
+    """
+    Content-addressed file name of a crop. The digest covers the decoded
+    pixels (or their perceptual hash) and the encoder settings, which pins
+    down the encoded bytes without having to encode the crop first.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    if naming == "perceptual":
+        digest.update(b"phash:")
+        digest.update(perceptual_hash(image))
+    elif naming == "content":
+        digest.update(f"{image.mode}:{image.size}:".encode())
+        digest.update(image.tobytes())
+    else:
+        raise ValueError(f"Unsupported crop naming: {naming}")
+    digest.update(_encoder_signature(encoder))
+    return digest.hexdigest() + encoder.extension
+
+
+class CropIndex:
+    """
+    Bounded LRU of crop paths that are stored, or queued for storage with the
+    future of their pending upload. A path whose upload fails is dropped.
+    """
+
+    def __init__(self, max_entries: int = 100000):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Optional[asyncio.Future]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, path: str) -> bool:
+        return self.lookup(path)[0]
+
+    def lookup(self, path: str) -> Tuple[bool, Optional[asyncio.Future]]:
+        """Whether `path` is known, and its pending upload if not stored yet."""
+        with self._lock:
+            if path in self._entries:
+                self._entries.move_to_end(path)
+                return True, self._entries[path]
+            return False, None
+
+    def add(self, path: str, pending: Optional[asyncio.Future] = None):
+        with self._lock:
+            self._entries[path] = pending
+            self._entries.move_to_end(path)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        if pending is not None:
+            pending.add_done_callback(lambda future: self._settle(path, future))
+
+    def _settle(self, path: str, future: asyncio.Future):
+        with self._lock:
+            if self._entries.get(path) is not future:
+                return
+            if future.cancelled() or future.exception() is not None:
+                del self._entries[path]
+            else:
+                self._entries[path] = None
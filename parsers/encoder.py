@@ -0,0 +1,120 @@
+import asyncio
+import io
+import multiprocessing
+from PIL import Image
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, Optional
+
+FORMATS: Dict[str, tuple] = {
+    # name -> (PIL format, file extension, content type)
+    "png": ("PNG", ".png", "image/png"),
+    "jpeg": ("JPEG", ".jpg", "image/jpeg"),
+    "jpg": ("JPEG", ".jpg", "image/jpeg"),
+    "webp": ("WEBP", ".webp", "image/webp"),
+}
+
+
+def _encode(
+    image: Image.Image,
+    format: str,
+    quality: int,
+    png_compress_level: int,
+    max_dimension: int,
+) -> bytes:
+    if max_dimension and max(image.size) > max_dimension:
+        image = image.copy()
+        image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+    pil_format = FORMATS[format][0]
+    if pil_format == "PNG":
+        params = {"compress_level": png_compress_level}
+    else:
+        params = {"quality": quality}
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, format=pil_format, **params)
+    return buffer.getvalue()
+
+
+class ImageEncoder:
+    """
+    Crop encoder configured by `encoder_args` in model_configs.yaml. Encoding
+    runs on its own thread or process pool so it does not compete with the
+    inference threads. `with_options` derives a per-request encoder sharing
+    the same pool.
+    """
+
+    def __init__(
+        self,
+        format: str = "png",
+        quality: int = 90,
+        png_compress_level: int = 6,
+        max_dimension: int = 0,
+        pool: str = "thread",
+        workers: int = 4,
+        executor: Optional[Executor] = None,
+    ):
+        format = format.lower()
+        if format not in FORMATS:
+            raise ValueError(f"Unsupported image format: {format}")
+        if not 0 <= quality <= 100:
+            raise ValueError(f"Image quality must be within 0-100: {quality}")
+        if not 0 <= png_compress_level <= 9:
+            raise ValueError(
+                f"PNG compress level must be within 0-9: {png_compress_level}"
+            )
+        if max_dimension < 0:
+            raise ValueError(f"Negative max_dimension: {max_dimension}")
+        self.format = format
+        self.quality = quality
+        self.png_compress_level = png_compress_level
+        self.max_dimension = max_dimension
+        self.pool = pool
+        self.workers = workers
+        if executor is None:
+            if pool == "process":
+                # forking would copy the parser's threads, locks and model
+                executor = ProcessPoolExecutor(
+                    max_workers=workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            elif pool == "thread":
+                executor = ThreadPoolExecutor(
+                    max_workers=workers, thread_name_prefix="crop-encode"
+                )
+            else:
+                raise ValueError(f"Unsupported encoder pool: {pool}")
+        self._executor = executor
+
+    @property
+    def extension(self) -> str:
+        return FORMATS[self.format][1]
+
+    @property
+    def content_type(self) -> str:
+        return FORMATS[self.format][2]
+
+    def with_options(self, **options) -> "ImageEncoder":
+        if not options:
+            return self
+        settings = {
+            "format": self.format,
+            "quality": self.quality,
+            "png_compress_level": self.png_compress_level,
+            "max_dimension": self.max_dimension,
+        }
+        settings.update(options)
+        return ImageEncoder(
+            pool=self.pool, workers=self.workers, executor=self._executor, **settings
+        )
+
+    async def encode(self, image: Image.Image) -> bytes:
+        return await asyncio.get_event_loop().run_in_executor(
+            self._executor,
+            _encode,
+            image,
+            self.format,
+            self.quality,
+            self.png_compress_level,
+            self.max_dimension,
+        )
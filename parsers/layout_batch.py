@@ -0,0 +1,115 @@
+import asyncio
+import logging
+import numpy as np
+from log import loggers
+from modules.layoutlmv3.detections import LayoutDetections
+from functools import partial
+from concurrent.futures import Executor
+from typing import Dict, List, Optional, Sequence, Tuple
+
+logger = loggers("layout", level=logging.INFO)
+
+PATCH_SIZE = 16
+# model input sizes (H, W) of pages resized to an 800 px short side: square,
+# US letter, A4 and the 1333 px long-side cap, portrait and landscape
+DEFAULT_BUCKETS = (
+    (800, 800),
+    (1056, 800),
+    (1152, 800),
+    (1344, 800),
+    (800, 1056),
+    (800, 1152),
+    (800, 1344),
+)
+
+
+def round_up(value: int, multiple: int) -> int:
+    return -(-value // multiple) * multiple
+
+
+class LayoutBatcher:
+    """
+    Batches layout detection across pages. Each image's model input size is
+    snapped to the smallest configured (H, W) bucket that holds it, and images
+    of one bucket run in a single forward pass padded to exactly that shape,
+    so the model only ever sees a handful of input shapes. A batch runs when
+    it is full or when its first image has waited `max_wait_ms`. Detections
+    are returned in the coordinates of each image.
+    """
+
+    def __init__(
+        self,
+        layout_model,
+        buckets: Sequence[Sequence[int]] = DEFAULT_BUCKETS,
+        batch_size: int = 4,
+        max_wait_ms: float = 10,
+        executor: Optional[Executor] = None,
+        ignore_catids: Sequence[int] = (),
+    ):
+        self.layout_model = layout_model
+        self.multiple = int(
+            np.lcm(PATCH_SIZE, getattr(layout_model, "size_divisibility", 0) or 1)
+        )
+        self.buckets: List[Tuple[int, int]] = sorted(
+            {
+                (round_up(h, self.multiple), round_up(w, self.multiple))
+                for h, w in buckets
+            },
+            key=lambda bucket: bucket[0] * bucket[1],
+        )
+        self.batch_size = batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.executor = executor
+        self.ignore_catids = list(ignore_catids)
+        self._pending: Dict[Tuple[int, int], List] = {}
+        self._timers: Dict[Tuple[int, int], asyncio.TimerHandle] = {}
+
+    def bucket(self, height: int, width: int) -> Tuple[int, int]:
+        """Smallest bucket holding a model input of the given size."""
+        for bucket in self.buckets:
+            if bucket[0] >= height and bucket[1] >= width:
+                return bucket
+        bucket = (round_up(height, self.multiple), round_up(width, self.multiple))
+        logger.debug(f"no layout bucket holds {height}x{width}, using {bucket}")
+        return bucket
+
+    async def detect(self, image: np.ndarray) -> LayoutDetections:
+        loop = asyncio.get_event_loop()
+        bucket = self.bucket(*self.layout_model.input_shape(*image.shape[:2]))
+        future = loop.create_future()
+        pending = self._pending.setdefault(bucket, [])
+        pending.append((image, future))
+        if len(pending) >= self.batch_size:
+            self._flush(bucket)
+        elif len(pending) == 1:
+            self._timers[bucket] = loop.call_later(self.max_wait, self._flush, bucket)
+        return await future
+
+    def _flush(self, bucket: Tuple[int, int]):
+        timer = self._timers.pop(bucket, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(bucket, None)
+        if batch:
+            asyncio.ensure_future(self._run(bucket, batch))
+
+    async def _run(self, bucket: Tuple[int, int], batch: List):
+        loop = asyncio.get_event_loop()
+        try:
+            results = await loop.run_in_executor(
+                self.executor,
+                partial(
+                    self.layout_model.batch,
+                    [image for image, _ in batch],
+                    ignore_catids=self.ignore_catids,
+                    pad_to=bucket,
+                ),
+            )
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
@@ -1,18 +1,34 @@
 import asyncio
+import collections
 import logging
 import os
 import cv2
-import tempfile
 import numpy as np
 from log import loggers
 from PIL import Image
 from minio import Minio
 from concurrent.futures import ThreadPoolExecutor
-from modules.extract_pdf import load_pdf_fitz
-from typing import Union, TypedDict, Literal, Optional, Tuple, List, Dict
+from modules.extract_pdf import (
+    LINEARIZATION_PROBE,
+    PageClipper,
+    RenderedPage,
+    first_page_document,
+    linearization,
+    page_count,
+)
+from modules.layoutlmv3.detections import LayoutDetections
+from modules.render import RenderService
+from modules.tiling import merge_tile_detections
+from .crops import CropIndex, crop_name
+from .encoder import ImageEncoder
+from .layout_batch import LayoutBatcher
+from .upload import CropUploader
+from typing import Union, TypedDict, Literal, Optional, Tuple, List, Dict, Set
 
 logger = loggers("pdf", level=logging.INFO)
 _thread_pool = ThreadPoolExecutor()
+# white border (pixels) around text regions sent to OCR
+OCR_MARGIN = 16
 
 
 class StorageConfig:
@@ -34,21 +50,32 @@ class TextChunk(TypedDict):
     bbox: Tuple[int, int, int, int]
     page: int
     page_size: Tuple[int, int]
+    dpi: int
     total_page: int
     bbox_num: int
+    source: str
 
 
 class OtherChunk(TypedDict):
     type: Literal["FORMULA", "FIGURE", "TABLE"]
     file_path: str
+    reference: str
     bbox: Tuple[int, int, int, int]
     page: int
     page_size: Tuple[int, int]
+    dpi: int
     total_page: int
     bbox_num: int
+    source: str
 
 
-Chunk = Union[TextChunk, OtherChunk]
+class ErrorChunk(TypedDict):
+    type: Literal["error"]
+    source: str
+    error: str
+
+
+Chunk = Union[TextChunk, OtherChunk, ErrorChunk]
 
 
 class PDFParser:
@@ -56,6 +83,34 @@ class PDFParser:
         self.layout_model = model_loader.layout_model
         self.ocr_model = model_loader.ocr_model
         self.dpi = model_loader.dpi
+        render_args = dict(model_loader.render_args)
+        # render the page raster straight at the layout model's input size and
+        # only clip regions for OCR and image export at full dpi
+        model_aware = render_args.pop("model_aware", False)
+        self.layout_size = self.layout_model.input_size if model_aware else None
+        self.renderer = RenderService(**render_args)
+        self.tile_batch_size: int = render_args.get("tiling", {}).get("batch_size", 4)
+        batching = dict(model_loader.layout_args.get("batching", {}))
+        self.layout_batcher = None
+        if batching.pop("enabled", False) and hasattr(self.layout_model, "batch"):
+            self.layout_batcher = LayoutBatcher(
+                self.layout_model,
+                executor=_thread_pool,
+                ignore_catids=[15],
+                **batching,
+            )
+        # pages of a document processed at once, so that layout batches fill
+        self.pages_in_flight: int = (
+            self.layout_batcher.batch_size if self.layout_batcher else 1
+        )
+        self.ingest_concurrency: int = model_loader.ingest_args.get("concurrency", 4)
+        self.ingest_extensions: List[str] = model_loader.ingest_args.get(
+            "extensions", [".pdf"]
+        )
+        self.uploader = CropUploader(**model_loader.upload_args)
+        self.default_encoder = ImageEncoder(**model_loader.encoder_args)
+        self.crop_naming: str = model_loader.crop_args.get("naming", "content")
+        self.crop_index = CropIndex(model_loader.crop_args.get("index_size", 100000))
         self.storage_config = None
         self.image_base_dir = os.path.join(
             os.path.dirname(os.path.dirname(__file__)), "images"
@@ -65,6 +120,10 @@ class PDFParser:
     def set_storage_config(self, storage_config):
         self.storage_config = storage_config
 
+    def encoder_for(self, options: Optional[Dict] = None) -> ImageEncoder:
+        """The crop encoder for per-request options; ValueError if unsupported."""
+        return self.default_encoder.with_options(**(options or {}))
+
     @staticmethod
     def merge_ocr_results(ocr_results) -> str:
         merged_text = ""
@@ -73,85 +132,175 @@ class PDFParser:
             merged_text += text
         return merged_text.strip()
 
-    async def save_image(self, image: Image.Image, filename: str) -> str:
+    @staticmethod
+    def _write_image(data: bytes, output_path: str):
+        with open(output_path, "wb") as f:
+            f.write(data)
+
+    async def save_image(
+        self,
+        image: Image.Image,
+        filename: str,
+        uploads: Optional[Set[asyncio.Future]] = None,
+        encoder: Optional[ImageEncoder] = None,
+    ) -> str:
+        """
+        Store a crop and return its path. MinIO uploads run in the background;
+        their futures are added to `uploads` for the caller to flush.
+        """
         loop = asyncio.get_event_loop()
+        encoder = encoder or self.default_encoder
+        deduplicate = self.crop_naming != "page"
+        if deduplicate:
+            # identical crops map to one stored object across documents
+            filename = await loop.run_in_executor(
+                _thread_pool, crop_name, image, encoder, self.crop_naming
+            )
+        else:
+            filename += encoder.extension
+
         if self.storage_config.storage_type == "LOCAL":
             output_path = os.path.join(self.image_base_dir, filename)
-            await loop.run_in_executor(_thread_pool, image.save, output_path)
+            if deduplicate and (
+                output_path in self.crop_index or os.path.exists(output_path)
+            ):
+                self.crop_index.add(output_path)
+                return output_path
+            data = await encoder.encode(image)
+            await loop.run_in_executor(
+                _thread_pool, self._write_image, data, output_path
+            )
+            if deduplicate:
+                self.crop_index.add(output_path)
             return output_path
         else:
-            with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as temp_file:
-                await loop.run_in_executor(_thread_pool, image.save, temp_file.name)
-                object_name = f"file/{filename}"
-                await loop.run_in_executor(
-                    _thread_pool,
-                    lambda: self.storage_config.minio_client.fput_object(
-                        self.storage_config.minio_bucket,
-                        object_name,
-                        temp_file.name,
-                    ),
+            object_name = f"file/{filename}"
+            stored_path = f"{self.storage_config.minio_bucket}/{object_name}"
+            if deduplicate:
+                known, pending = self.crop_index.lookup(stored_path)
+                if known:
+                    # another request is still uploading it, wait for that one
+                    if pending is not None and uploads is not None:
+                        uploads.add(pending)
+                    return stored_path
+
+            # indexed before queueing, so concurrent requests find the upload
+            future = loop.create_future()
+            if deduplicate:
+                self.crop_index.add(stored_path, future)
+            if uploads is not None:
+                uploads.add(future)
+            try:
+                await self.uploader.submit(
+                    self.storage_config,
+                    object_name,
+                    image,
+                    encoder,
+                    skip_existing=deduplicate,
+                    future=future,
                 )
-                os.unlink(temp_file.name)
-                return f"{self.storage_config.minio_bucket}/{object_name}"
+            except BaseException:
+                # never queued, requests sharing the future must not wait forever
+                future.cancel()
+                raise
+            # the object path is deterministic, so it can be returned right away
+            return stored_path
+
+    async def crop_region(
+        self,
+        page: RenderedPage,
+        page_idx: int,
+        bbox: Tuple[int, int, int, int],
+        clipper: Optional[PageClipper] = None,
+        color: bool = False,
+    ) -> np.ndarray:
+        """
+        BGR (or gray) crop of `bbox` (output pixels) at the output resolution.
+        With `color`, regions of gray pages are clipped from the PDF in colour.
+        """
+        gray = page.gray and not color
+        if page.scale == page.output_scale and not page.tiles and gray == page.gray:
+            xmin, ymin, xmax, ymax = bbox
+            return page.image[ymin:ymax, xmin:xmax]
+        rect = tuple(v / page.output_scale for v in bbox)
+        return await asyncio.get_event_loop().run_in_executor(
+            _thread_pool, clipper.clip, page_idx, rect, page.output_scale, gray
+        )
 
     async def process_image(
         self,
-        image: np.ndarray,
-        res: Dict,
+        page: RenderedPage,
+        bbox: Tuple[int, int, int, int],
+        category_id: int,
         page_idx: int,
         total_page: int,
         bbox_count: int,
+        document: str,
+        clipper: Optional[PageClipper] = None,
+        uploads: Optional[Set[asyncio.Future]] = None,
+        encoder: Optional[ImageEncoder] = None,
     ) -> OtherChunk:
-        img_W, img_H = image.shape[:2]
-        xmin, ymin = int(res["poly"][0]), int(res["poly"][1])
-        xmax, ymax = int(res["poly"][4]), int(res["poly"][5])
-        bbox = (xmin, ymin, xmax, ymax)
+        xmin, ymin, xmax, ymax = bbox
 
         category_map: Dict[int, Literal["FIGURE", "TABLE", "FORMULA"]] = {
             3: "FIGURE",
             5: "TABLE",
             8: "FORMULA",
         }
-        img_type: Optional[str] = category_map.get(res["category_id"])
+        img_type: Optional[str] = category_map.get(category_id)
 
         if img_type is None:
-            raise ValueError(f"Unsupported category_id: {res['category_id']}")
+            raise ValueError(f"Unsupported category_id: {category_id}")
 
-        img = Image.fromarray(
-            cv2.cvtColor(image[ymin:ymax, xmin:xmax], cv2.COLOR_BGR2RGB)
+        # the colour check runs on a thumbnail, where small coloured figures
+        # vanish; gray is only used for layout and OCR
+        crop = await self.crop_region(
+            page, page_idx, bbox, clipper, color=img_type in ("FIGURE", "TABLE")
         )
+        if crop.ndim == 2:
+            # fromarray shares contiguous memory, and the page buffer is reused
+            # or unmapped once the page is released, before the upload encodes
+            img = Image.fromarray(np.array(crop), mode="L")
+        else:
+            img = Image.fromarray(cv2.cvtColor(crop, cv2.COLOR_BGR2RGB))
 
-        filename = f"page_{page_idx+1}_{img_type.lower()}_{xmin}_{ymin}.png"
-        saved_path = await self.save_image(img, filename)
+        filename = f"page_{page_idx+1}_{img_type.lower()}_{xmin}_{ymin}"
+        saved_path = await self.save_image(img, filename, uploads, encoder)
 
         return {
             "type": img_type,
             "file_path": saved_path,
+            "reference": f"{document}/{filename}",
             "bbox": bbox,
             "page": page_idx,
-            "page_size": (img_W, img_H),
+            "page_size": page.output_size,
+            "dpi": page.dpi,
             "total_page": total_page,
             "bbox_num": bbox_count,
         }
 
     async def process_text(
         self,
-        image: np.ndarray,
-        pil_img: Image.Image,
-        res: Dict,
+        page: RenderedPage,
+        bbox: Tuple[int, int, int, int],
         page_idx: int,
         total_page: int,
         bbox_count: int,
         lock: asyncio.Lock,
+        clipper: Optional[PageClipper] = None,
     ) -> Union[TextChunk, None]:
         loop = asyncio.get_event_loop()
-        img_W, img_H = image.shape[:2]
-        xmin, ymin = int(res["poly"][0]), int(res["poly"][1])
-        xmax, ymax = int(res["poly"][4]), int(res["poly"][5])
-        crop_box = (xmin, ymin, xmax, ymax)
-        cropped_img = Image.new("RGB", pil_img.size, "white")
-        cropped_img.paste(pil_img.crop(crop_box), crop_box)
-        cropped_img = cv2.cvtColor(np.asarray(cropped_img), cv2.COLOR_RGB2BGR)
+        crop = await self.crop_region(page, page_idx, bbox, clipper)
+        # OCR only the region, on a white margin instead of a blank full page
+        cropped_img = cv2.copyMakeBorder(
+            crop,
+            OCR_MARGIN,
+            OCR_MARGIN,
+            OCR_MARGIN,
+            OCR_MARGIN,
+            cv2.BORDER_CONSTANT,
+            value=(255, 255, 255),
+        )
 
         async with lock:
             try:
@@ -164,9 +313,10 @@ class PDFParser:
                     return {
                         "type": "text",
                         "text": merged_text,
-                        "bbox": (xmin, ymin, xmax, ymax),
+                        "bbox": bbox,
                         "page": page_idx,
-                        "page_size": (img_W, img_H),
+                        "page_size": page.output_size,
+                        "dpi": page.dpi,
                         "total_page": total_page,
                         "bbox_num": bbox_count,
                     }
@@ -208,42 +358,96 @@ class PDFParser:
 
         return final_output
 
+    def _detect_batch(self, images: List[np.ndarray]) -> List[LayoutDetections]:
+        if hasattr(self.layout_model, "batch"):
+            return self.layout_model.batch(images, ignore_catids=[15])
+        return [self.layout_model(image, ignore_catids=[15]) for image in images]
+
+    async def detect_tiles(self, page: RenderedPage) -> LayoutDetections:
+        """Run layout on the tiles of an oversized page and merge the results."""
+        loop = asyncio.get_event_loop()
+        factor = page.output_scale / page.scale
+        if self.layout_batcher is not None:
+            results = await asyncio.gather(
+                *(self.layout_batcher.detect(tile) for tile in page.image)
+            )
+        else:
+            results = []
+            for start in range(0, len(page.tiles), self.tile_batch_size):
+                images = list(page.image[start : start + self.tile_batch_size])
+                results.extend(
+                    await loop.run_in_executor(_thread_pool, self._detect_batch, images)
+                )
+        detections = []
+        for tile, result in zip(page.tiles, results):
+            bboxes = result.boxes.astype(np.float64) * factor + np.tile(tile[:2], 2)
+            for bbox, label, score in zip(
+                bboxes.tolist(), result.labels.tolist(), result.scores.tolist()
+            ):
+                detections.append(
+                    {
+                        "category_id": label,
+                        "score": score,
+                        "tile": tile,
+                        "bbox": tuple(bbox),
+                    }
+                )
+        return LayoutDetections(*merge_tile_detections(detections, page.output_size))
+
     async def process_single_page(
         self,
-        image: np.ndarray,
+        page: RenderedPage,
         page_idx: int,
         total_page: int,
+        document: str = "document",
+        clipper: Optional[PageClipper] = None,
+        uploads: Optional[Set[asyncio.Future]] = None,
+        encoder: Optional[ImageEncoder] = None,
     ):
         loop = asyncio.get_event_loop()
         lock = asyncio.Lock()
+        image = page.image
 
-        layout_res = await loop.run_in_executor(
-            _thread_pool, lambda: self.layout_model(image, ignore_catids=[15])
-        )
-        bbox_count = len(
-            [res for res in layout_res["layout_dets"] if res["category_id"] != 15]
-        )
+        if page.tiles:
+            layout_res = await self.detect_tiles(page)
+            factor = 1
+        else:
+            if self.layout_batcher is not None:
+                layout_res = await self.layout_batcher.detect(image)
+            else:
+                layout_res = await loop.run_in_executor(
+                    _thread_pool, lambda: self.layout_model(image, ignore_catids=[15])
+                )
+            # detections are in raster pixels, chunks report output pixels
+            factor = page.output_scale / page.scale
+        bbox_count = int(np.count_nonzero(layout_res.labels != 15))
 
         chunks = []
-        for res in layout_res["layout_dets"]:
-            if res["category_id"] in {3, 5, 8}:
+        bboxes = (layout_res.boxes.astype(np.float64) * factor).astype(int)
+        for bbox, category_id in zip(bboxes.tolist(), layout_res.labels.tolist()):
+            bbox = tuple(bbox)
+            if category_id in {3, 5, 8}:
                 chunk = self.process_image(
-                    image,
-                    res,
+                    page,
+                    bbox,
+                    category_id,
                     page_idx,
                     total_page,
                     bbox_count,
+                    document,
+                    clipper,
+                    uploads,
+                    encoder,
                 )
-            elif res["category_id"] in {0, 1, 2, 4, 6, 7}:
-                pil_img = Image.fromarray(cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
+            elif category_id in {0, 1, 2, 4, 6, 7}:
                 chunk = self.process_text(
-                    image,
-                    pil_img,
-                    res,
+                    page,
+                    bbox,
                     page_idx,
                     total_page,
                     bbox_count,
                     lock,
+                    clipper,
                 )
             else:
                 continue
@@ -254,32 +458,238 @@ class PDFParser:
         filtered_chunks = self.check_bboxes_overlap(page_chunk, overlap_threshold=0.9)
         return filtered_chunks
 
-    async def process_pdf_files(
+    async def process_document(
         self,
-        pdf_path,
+        pdf_path: Union[str, bytes],
+        document_name: str,
+        source: str,
+        first_page: int = 0,
+        stop_page: Optional[int] = None,
+        total_page: Optional[int] = None,
+        uploads: Optional[Set[asyncio.Future]] = None,
+        encoder: Optional[ImageEncoder] = None,
     ):
+        """
+        Yield the chunks of pages [first_page, stop_page) of one PDF, tagged
+        with its `source`. `total_page` overrides the page total reported in
+        chunks, for partial documents. Crops are encoded with `encoder` and
+        their uploads added to `uploads`.
+        """
         loop = asyncio.get_event_loop()
-        if os.path.isdir(pdf_path):
-            all_pdfs = [os.path.join(pdf_path, name) for name in os.listdir(pdf_path)]
-        else:
-            all_pdfs = [pdf_path]
-
-        for idx, single_pdf in enumerate(all_pdfs):
+        try:
+            page_total = await loop.run_in_executor(_thread_pool, page_count, pdf_path)
+        except ZeroDivisionError:
+            print("unexpected pdf file:", source)
+            return
+        if stop_page is not None:
+            page_total = min(page_total, stop_page)
+        total_page = total_page or page_total
+
+        clipper = None
+        if (
+            self.layout_size is not None
+            or self.renderer.tiling is not None
+            or self.renderer.color_mode != "rgb"
+        ):
+            clipper = await loop.run_in_executor(_thread_pool, PageClipper, pdf_path)
+
+        async def process(rendered: RenderedPage, page_idx: int):
             try:
-                img_list = await loop.run_in_executor(
-                    _thread_pool, lambda: load_pdf_fitz(single_pdf, dpi=self.dpi)
-                )
-            except ZeroDivisionError:
-                img_list = None
-                print("unexpected pdf file:", single_pdf)
-            if img_list is None:
-                continue
-
-            total_page = len(img_list)
-            for page_idx, image in enumerate(img_list):
                 page_output = await self.process_single_page(
-                    image,
+                    rendered,
                     page_idx,
                     total_page,
+                    document_name,
+                    clipper,
+                    uploads,
+                    encoder,
                 )
+            finally:
+                rendered.release()
+            for chunk in page_output:
+                chunk["source"] = source
+            return page_output
+
+        # up to pages_in_flight pages are processed at once, output stays in
+        # page order
+        in_flight = collections.deque()
+        page_idx = first_page
+        try:
+            async for rendered in self.renderer.render(
+                pdf_path,
+                self.dpi,
+                page_total,
+                thread_pool=_thread_pool,
+                layout_size=self.layout_size,
+                first_page=first_page,
+            ):
+                in_flight.append(
+                    (asyncio.ensure_future(process(rendered, page_idx)), rendered)
+                )
+                page_idx += 1
+                if len(in_flight) >= self.pages_in_flight:
+                    yield await in_flight.popleft()[0]
+            while in_flight:
+                yield await in_flight.popleft()[0]
+        finally:
+            for task, _ in in_flight:
+                task.cancel()
+            await asyncio.gather(
+                *(task for task, _ in in_flight), return_exceptions=True
+            )
+            # tasks cancelled before their first step never reach their own
+            # release, and pages hold shared memory blocks
+            for _, rendered in in_flight:
+                rendered.release()
+
+    async def process_collection(
+        self, root: str, encoder: Optional[ImageEncoder] = None
+    ):
+        """
+        Parse every document listed under a directory or MinIO prefix, up to
+        `ingest_concurrency` at a time. Pages are yielded as they complete, so
+        outputs of different documents interleave; a document that fails,
+        including its crop uploads, yields a single error chunk and the others
+        carry on.
+        """
+        loop = asyncio.get_event_loop()
+        sources = await loop.run_in_executor(
+            _thread_pool,
+            self.storage_config.list_documents,
+            root,
+            self.ingest_extensions,
+        )
+        logger.info(f"Found {len(sources)} documents under {root}")
+        queue: asyncio.Queue = asyncio.Queue(maxsize=2 * self.ingest_concurrency)
+        pending = iter(sources)
+
+        async def drain(source: str):
+            # names relative to the root keep references of equally named
+            # files in different folders apart
+            document_name = os.path.splitext(os.path.relpath(source, root))[0]
+            uploads: Set[asyncio.Future] = set()
+            try:
+                async with self.storage_config.open_file(
+                    source, exact_name=True
+                ) as pdf_path:
+                    async for page_output in self.process_document(
+                        pdf_path,
+                        document_name,
+                        source,
+                        uploads=uploads,
+                        encoder=encoder,
+                    ):
+                        await queue.put(page_output)
+                # flushed per document, so a failed upload is reported for
+                # the document it belongs to
+                await self.flush_uploads(uploads)
+            except Exception as e:
+                logger.error(f"Failed to parse {source}: {e}")
+                error: ErrorChunk = {"type": "error", "source": source, "error": str(e)}
+                await queue.put([error])
+
+        async def worker():
+            # the iterator is shared, each worker takes the next document
+            for source in pending:
+                await drain(source)
+            await queue.put(None)
+
+        workers = [
+            asyncio.create_task(worker())
+            for _ in range(min(self.ingest_concurrency, len(sources)))
+        ]
+        try:
+            finished = 0
+            while finished < len(workers):
+                page_output = await queue.get()
+                if page_output is None:
+                    finished += 1
+                else:
+                    yield page_output
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    async def process_pdf_files(
+        self,
+        pdf_path: Union[str, bytes],
+        document: Optional[str] = None,
+        encoder: Optional[ImageEncoder] = None,
+    ):
+        if isinstance(pdf_path, str) and self.storage_config.is_collection(pdf_path):
+            async for page_output in self.process_collection(pdf_path, encoder):
                 yield page_output
+            return
+        source = document or (pdf_path if isinstance(pdf_path, str) else "")
+        document_name = os.path.splitext(os.path.basename(source))[0]
+        # crop uploads of this call, flushed once its pages are out
+        uploads: Set[asyncio.Future] = set()
+        async for page_output in self.process_document(
+            pdf_path,
+            document_name or "document",
+            source or "<in-memory>",
+            uploads=uploads,
+            encoder=encoder,
+        ):
+            yield page_output
+        await self.flush_uploads(uploads)
+
+    async def process_progressive(
+        self, download, document: str, encoder: Optional[ImageEncoder] = None
+    ):
+        """
+        Parse a PDF that is still downloading (a `service.storage.ProgressiveDownload`).
+        For linearized files the first page is parsed as soon as its section
+        has arrived, the remaining pages once the download completes. Other
+        files are parsed after the download, as with `process_pdf_files`.
+        """
+        loop = asyncio.get_event_loop()
+        document_name = os.path.splitext(os.path.basename(document))[0] or "document"
+        uploads: Set[asyncio.Future] = set()
+        first_page = 0
+        info = linearization(await download.read_head(LINEARIZATION_PROBE))
+        # /L no longer matches after incremental updates, whose objects may
+        # replace those of the first page
+        if info is not None and info.length == download.size and info.page_count > 1:
+            try:
+                head = await download.read_head(info.first_page_end)
+                partial = await loop.run_in_executor(
+                    _thread_pool, first_page_document, head, info
+                )
+            except Exception as e:
+                logger.warning(f"Falling back to the full download of {document}: {e}")
+                partial = None
+            if partial is not None:
+                logger.info(f"Parsing the first page of {document} while downloading")
+                async for page_output in self.process_document(
+                    partial,
+                    document_name,
+                    document,
+                    stop_page=1,
+                    total_page=info.page_count,
+                    uploads=uploads,
+                    encoder=encoder,
+                ):
+                    yield page_output
+                first_page = 1
+
+        pdf_path = await download.result()
+        async for page_output in self.process_document(
+            pdf_path,
+            document_name,
+            document,
+            first_page=first_page,
+            uploads=uploads,
+            encoder=encoder,
+        ):
+            yield page_output
+        await self.flush_uploads(uploads)
+
+    async def flush_uploads(self, uploads: Set[asyncio.Future]):
+        if self.uploader.wait_for_durability:
+            failures = await self.uploader.flush(uploads)
+            if failures:
+                raise RuntimeError(
+                    f"{len(failures)} crop uploads failed, first error: {failures[0]}"
+                )
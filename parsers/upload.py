@@ -0,0 +1,224 @@
+import asyncio
+import io
+import logging
+from PIL import Image
+from log import loggers
+from minio.error import S3Error
+from .encoder import ImageEncoder
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List, Optional, Tuple
+
+logger = loggers("upload", level=logging.INFO)
+
+
+class UploadJob:
+    def __init__(
+        self,
+        storage_config,
+        object_name: str,
+        image: Image.Image,
+        encoder: ImageEncoder,
+        skip_existing: bool = False,
+    ):
+        self.storage_config = storage_config
+        self.object_name = object_name
+        self.image = image
+        self.encoder = encoder
+        self.skip_existing = skip_existing
+        self.data: Optional[bytes] = None
+        self.attempts = 0
+
+    @property
+    def path(self) -> str:
+        return f"{self.storage_config.minio_bucket}/{self.object_name}"
+
+
+class CropUploader:
+    """
+    Background uploader for page crops. `submit` only waits for a queue slot,
+    so region tasks return as soon as the crop is queued. Workers pull batches
+    from a bounded queue, upload them on a dedicated thread pool and retry
+    failures with exponential backoff.
+    """
+
+    def __init__(
+        self,
+        queue_size: int = 256,
+        concurrency: int = 4,
+        batch_size: int = 8,
+        max_retries: int = 3,
+        retry_backoff: float = 0.5,
+        wait_for_durability: bool = True,
+    ):
+        self.queue_size = queue_size
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.wait_for_durability = wait_for_durability
+        self._thread_pool = ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix="crop-upload"
+        )
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+
+    def _ensure_started(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.queue_size)
+            self._workers = [
+                asyncio.ensure_future(self._worker()) for _ in range(self.concurrency)
+            ]
+
+    async def submit(
+        self,
+        storage_config,
+        object_name: str,
+        image: Image.Image,
+        encoder: ImageEncoder,
+        skip_existing: bool = False,
+        future: Optional[asyncio.Future] = None,
+    ):
+        """
+        Queue a crop for upload and return a future resolving to its path,
+        `future` if given. With `skip_existing`, objects already present in
+        the bucket are neither encoded nor uploaded again.
+        """
+        self._ensure_started()
+        if future is None:
+            future = asyncio.get_event_loop().create_future()
+        job = UploadJob(storage_config, object_name, image, encoder, skip_existing)
+        await self._queue.put((job, future))
+        return future
+
+    @staticmethod
+    async def flush(futures: Iterable[asyncio.Future]) -> List[BaseException]:
+        """
+        Wait for the given uploads, as returned by `submit`, and return the
+        failures. Cancelling the wait leaves the uploads themselves running.
+        """
+        futures = list(futures)
+        if futures:
+            await asyncio.wait(futures)
+        failures = []
+        for future in futures:
+            if future.cancelled():
+                failures.append(asyncio.CancelledError("upload was cancelled"))
+            elif future.exception() is not None:
+                failures.append(future.exception())
+        return failures
+
+    @staticmethod
+    def _upload(job: UploadJob):
+        job.storage_config.minio_client.put_object(
+            job.storage_config.minio_bucket,
+            job.object_name,
+            io.BytesIO(job.data),
+            len(job.data),
+            content_type=job.encoder.content_type,
+        )
+
+    @staticmethod
+    def _exists(job: UploadJob) -> bool:
+        try:
+            job.storage_config.minio_client.stat_object(
+                job.storage_config.minio_bucket, job.object_name
+            )
+            return True
+        except S3Error as e:
+            if e.code in ("NoSuchKey", "NoSuchObject"):
+                return False
+            raise
+
+    def _exists_batch(
+        self, batch: List[Tuple[UploadJob, asyncio.Future]]
+    ) -> List[bool]:
+        # lookup errors fall through to a regular upload attempt
+        exists = []
+        for job, _ in batch:
+            try:
+                exists.append(job.skip_existing and self._exists(job))
+            except Exception:
+                exists.append(False)
+        return exists
+
+    def _upload_batch(
+        self, batch: List[Tuple[UploadJob, asyncio.Future]]
+    ) -> List[Optional[Exception]]:
+        errors = []
+        for job, _ in batch:
+            try:
+                self._upload(job)
+                errors.append(None)
+            except Exception as e:
+                errors.append(e)
+        return errors
+
+    async def _worker(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+
+            if any(job.skip_existing for job, _ in batch):
+                exists = await loop.run_in_executor(
+                    self._thread_pool, self._exists_batch, batch
+                )
+                for (job, future), found in zip(list(batch), exists):
+                    if found:
+                        if not future.done():
+                            future.set_result(job.path)
+                        batch.remove((job, future))
+                        self._queue.task_done()
+                if not batch:
+                    continue
+
+            encoded = await asyncio.gather(
+                *(job.encoder.encode(job.image) for job, _ in batch),
+                return_exceptions=True,
+            )
+            for (job, future), data in zip(list(batch), encoded):
+                job.image = None
+                if isinstance(data, Exception):
+                    logger.error(f"Encoding of {job.path} failed: {data}")
+                    if not future.done():
+                        future.set_exception(data)
+                    batch.remove((job, future))
+                    self._queue.task_done()
+                else:
+                    job.data = data
+
+            while batch:
+                try:
+                    errors = await loop.run_in_executor(
+                        self._thread_pool, self._upload_batch, batch
+                    )
+                except Exception as e:
+                    errors = [e] * len(batch)
+
+                retry = []
+                for (job, future), error in zip(batch, errors):
+                    if error is None:
+                        if not future.done():
+                            future.set_result(job.path)
+                        continue
+                    job.attempts += 1
+                    if job.attempts > self.max_retries:
+                        logger.error(f"Upload of {job.path} failed: {error}")
+                        if not future.done():
+                            future.set_exception(error)
+                    else:
+                        logger.warning(
+                            f"Upload of {job.path} failed (attempt {job.attempts}): {error}"
+                        )
+                        retry.append((job, future))
+
+                for _ in range(len(batch) - len(retry)):
+                    self._queue.task_done()
+                if retry:
+                    attempts = max(job.attempts for job, _ in retry)
+                    await asyncio.sleep(self.retry_backoff * 2 ** (attempts - 1))
+                batch = retry
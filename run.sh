@@ -8,6 +8,10 @@ case $1 in
 	export MINIO_ENDPOINT="localhost:9000"
 	export MINIO_ACCESS_KEY="minioadmin"
 	export MINIO_SECRET_KEY="minioadmin"
+	export MINIO_MEMORY_THRESHOLD="67108864"
+	export MINIO_CACHE_DIR=""
+	export MINIO_CACHE_MAX_BYTES="10737418240"
+	export MINIO_PROGRESSIVE_THRESHOLD="16777216"
 	python main.py
 	;;
 "build")
@@ -1,64 +1,16 @@
 import logging
 import grpc
 import os
-import asyncio
+from contextlib import AsyncExitStack
 from log import loggers
-from minio import Minio
-from typing import AsyncGenerator
+from typing import AsyncGenerator, Optional, Union
 from parsers import Mime
-from typing import Optional
-from concurrent.futures import ThreadPoolExecutor
 from parsers import PDFParser, TxtParser, MarkdownParser
+from parsers.encoder import ImageEncoder
 from rpc import file_parser_pb2, file_parser_pb2_grpc
-
+from .storage import ProgressiveDownload, StorageConfig
 
 logger = loggers("mod", level=logging.INFO)
-_thread_pool = ThreadPoolExecutor()
-
-
-class StorageConfig:
-    def __init__(self, storage_type: str, minio_bucket: Optional[str] = None):
-        self.storage_type = storage_type
-        self.minio_bucket = minio_bucket
-        if storage_type == "MINIO":
-            self.minio_client = Minio(
-                os.getenv("MINIO_ENDPOINT", "localhost:9000"),
-                access_key=os.getenv("MINIO_ACCESS_KEY"),
-                secret_key=os.getenv("MINIO_SECRET_KEY"),
-                secure=False,
-            )
-
-    async def download_file(self, file_path: str, local_path: str):
-        if self.storage_type == "LOCAL":  # local file
-            if not os.path.exists(file_path):
-                raise FileNotFoundError(f"File not found: {file_path}")
-            if not os.path.isfile(file_path):
-                raise IsADirectoryError(f"Path is a directory: {file_path}")
-            return file_path
-        else:
-            try:
-                if file_path.startswith("file/"):
-                    object_name = file_path
-                else:
-                    object_name = os.path.basename(file_path)
-                    if not object_name:
-                        raise ValueError(f"Invalid file path: {file_path}")
-
-                logger.info(
-                    f"Downloading from MinIO - bucket: {self.minio_bucket}, object: {object_name}"
-                )
-
-                os.makedirs(os.path.dirname(local_path), exist_ok=True)
-                await asyncio.get_event_loop().run_in_executor(
-                    None,
-                    lambda: self.minio_client.fget_object(
-                        self.minio_bucket, object_name, local_path
-                    ),
-                )
-                return local_path
-            except Exception as e:
-                logger.error(f"MinIO download error: {e}")
-                raise
 
 
 class FileParser(file_parser_pb2_grpc.FileParserServicer):
@@ -71,6 +23,19 @@ class FileParser(file_parser_pb2_grpc.FileParserServicer):
         model_loader = ModelLoader()
         self.pdf_parser = PDFParser(model_loader)
 
+    @staticmethod
+    def _get_encoder_options(request: file_parser_pb2.ParseRequest) -> dict:
+        if not request.HasField("image_encoding"):
+            return {}
+        encoding = request.image_encoding
+        options = {}
+        if encoding.format:
+            options["format"] = encoding.format
+        for field in ("quality", "png_compress_level", "max_dimension"):
+            if encoding.HasField(field):
+                options[field] = getattr(encoding, field)
+        return options
+
     def _get_mime_from_path(self, file_path: str) -> str:
         """Determine MIME type from file extension"""
         extension = os.path.splitext(file_path)[1].lower()
@@ -82,12 +47,27 @@ class FileParser(file_parser_pb2_grpc.FileParserServicer):
         return mime_map.get(extension, "application/octet-stream")
 
     async def parse_pdf(
-        self, file_path: str, storage_config: StorageConfig
+        self,
+        file_path: Union[str, bytes, ProgressiveDownload],
+        storage_config: StorageConfig,
+        document: Optional[str] = None,
+        encoder: Optional[ImageEncoder] = None,
     ) -> AsyncGenerator[file_parser_pb2.ParseResponse, None]:
         self.pdf_parser.set_storage_config(storage_config)
-        async for page_output in self.pdf_parser.process_pdf_files(file_path):
+        if isinstance(file_path, ProgressiveDownload):
+            outputs = self.pdf_parser.process_progressive(file_path, document, encoder)
+        else:
+            outputs = self.pdf_parser.process_pdf_files(
+                file_path, document=document, encoder=encoder
+            )
+        async for page_output in outputs:
             for item in page_output:
-                if item["type"] == "text":
+                if item["type"] == "error":
+                    response = file_parser_pb2.ParseResponse(
+                        error=file_parser_pb2.DocumentError(message=item["error"]),
+                        source=item["source"],
+                    )
+                elif item["type"] == "text":
                     response = file_parser_pb2.ParseResponse(
                         text=file_parser_pb2.TextChunk(content=item["text"]),
                         bbox=item["bbox"],
@@ -96,14 +76,17 @@ class FileParser(file_parser_pb2_grpc.FileParserServicer):
                             height=item["page_size"][0],
                             page=item["page"],
                             total=item["total_page"],
+                            dpi=item["dpi"],
                         ),
                         bbox_num=item["bbox_num"],
+                        source=item["source"],
                     )
                 else:
                     type_enum = file_parser_pb2.ImageType.Value(item["type"])
                     response = file_parser_pb2.ParseResponse(
                         image=file_parser_pb2.ImageChunk(
                             file_path=item["file_path"],
+                            reference=item["reference"],
                             **{"class": type_enum},
                         ),
                         bbox=item["bbox"],
@@ -112,8 +95,10 @@ class FileParser(file_parser_pb2_grpc.FileParserServicer):
                             height=item["page_size"][0],
                             page=item["page"],
                             total=item["total_page"],
+                            dpi=item["dpi"],
                         ),
                         bbox_num=item["bbox_num"],
+                        source=item["source"],
                     )
                 yield response
 
@@ -137,6 +122,12 @@ class FileParser(file_parser_pb2_grpc.FileParserServicer):
         file_path = request.file_path
         storage_type = request.storage_type
         logger.info(f"Parsing file: {file_path} with storage type: {storage_type}")
+        try:
+            encoder = self.pdf_parser.encoder_for(self._get_encoder_options(request))
+        except ValueError as e:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details(f"Invalid image encoding: {e}")
+            return
 
         try:
             storage_config = StorageConfig(
@@ -147,40 +138,66 @@ class FileParser(file_parser_pb2_grpc.FileParserServicer):
                     else None
                 ),
             )
-            try:
-                local_path = await storage_config.download_file(file_path, file_path)
-                logger.info(f"Using file at path: {local_path}")
-            except FileNotFoundError:
-                context.set_code(grpc.StatusCode.NOT_FOUND)
-                context.set_details(f"File not found: {file_path}")
-                return
-            except Exception as e:
-                context.set_code(grpc.StatusCode.INTERNAL)
-                context.set_details(f"Error accessing file: {str(e)}")
-                return
             self.pdf_parser.set_storage_config(storage_config)
-            mime_type = Mime.from_str(self._get_mime_from_path(file_path))
-            logger.info(f"Detected MIME type: {mime_type}")
-
-            if mime_type == Mime.Pdf:
-                async for response in self.parse_pdf(local_path, storage_config):
+            if storage_config.is_collection(file_path):
+                logger.info(f"Parsing PDF documents under: {file_path}")
+                async for response in self.parse_pdf(
+                    file_path, storage_config, document=file_path, encoder=encoder
+                ):
                     yield response
                     logger.info("Sent PDF chunk")
-            elif mime_type == Mime.Txt:
-                async for response in self.parse_txt(local_path, storage_config):
-                    yield response
-                    logger.info("Sent text chunk")
-            elif mime_type == Mime.Md:
-                async for response in self.parse_markdown(local_path, storage_config):
-                    yield response
-                    logger.info("Sent markdown chunk")
-            else:
-                error_msg = f"Unsupported file type: {mime_type}"
-                logger.error(error_msg)
-                context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
-                context.set_details(error_msg)
+                logger.info("Collection processing completed")
                 return
 
+            mime_type = Mime.from_str(self._get_mime_from_path(file_path))
+            logger.info(f"Detected MIME type: {mime_type}")
+            async with AsyncExitStack() as stack:
+                try:
+                    local_path = await stack.enter_async_context(
+                        storage_config.open_file(
+                            file_path,
+                            in_memory=mime_type == Mime.Pdf,
+                            progressive=mime_type == Mime.Pdf,
+                        )
+                    )
+                    if isinstance(local_path, ProgressiveDownload):
+                        logger.info(f"Parsing while downloading: {file_path}")
+                    elif isinstance(local_path, str):
+                        logger.info(f"Using file at path: {local_path}")
+                    else:
+                        logger.info(f"Using in-memory copy of: {file_path}")
+                except FileNotFoundError:
+                    context.set_code(grpc.StatusCode.NOT_FOUND)
+                    context.set_details(f"File not found: {file_path}")
+                    return
+                except Exception as e:
+                    context.set_code(grpc.StatusCode.INTERNAL)
+                    context.set_details(f"Error accessing file: {str(e)}")
+                    return
+
+                if mime_type == Mime.Pdf:
+                    async for response in self.parse_pdf(
+                        local_path, storage_config, document=file_path, encoder=encoder
+                    ):
+                        yield response
+                        logger.info("Sent PDF chunk")
+                elif mime_type == Mime.Txt:
+                    async for response in self.parse_txt(local_path, storage_config):
+                        yield response
+                        logger.info("Sent text chunk")
+                elif mime_type == Mime.Md:
+                    async for response in self.parse_markdown(
+                        local_path, storage_config
+                    ):
+                        yield response
+                        logger.info("Sent markdown chunk")
+                else:
+                    error_msg = f"Unsupported file type: {mime_type}"
+                    logger.error(error_msg)
+                    context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+                    context.set_details(error_msg)
+                    return
+
             logger.info("File processing completed successfully")
 
         except Exception as e:
@@ -0,0 +1,480 @@
+import asyncio
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable, Dict, List, Optional, Sequence, Union
+from minio import Minio
+from log import loggers
+
+logger = loggers("storage", level=logging.INFO)
+
+# objects up to this size are fetched into memory instead of a local file
+DEFAULT_MEMORY_THRESHOLD = 64 * 1024 * 1024
+DEFAULT_CACHE_MAX_BYTES = 10 * 1024 * 1024 * 1024
+# objects larger than this are parsed while they download, if the parser can
+DEFAULT_PROGRESSIVE_THRESHOLD = 16 * 1024 * 1024
+PROGRESSIVE_CHUNK_SIZE = 1024 * 1024
+
+
+class ProgressiveDownload:
+    """
+    A MinIO object streamed by a background thread into memory, or into
+    `path` when given. Readers can wait for a prefix of the object with
+    `read_head` before the whole download completes.
+    """
+
+    def __init__(self, client, bucket: str, object_name: str, size: int, path=None):
+        self.object_name = object_name
+        self.size = size
+        self.path = path
+        self._buffer = bytearray(size) if path is None else None
+        self._received = 0
+        self._done = False
+        self._cancelled = False
+        self._error: Optional[BaseException] = None
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(
+            target=self._run, args=(client, bucket), daemon=True
+        )
+        self._thread.start()
+
+    def _run(self, client, bucket: str):
+        out = None
+        try:
+            response = client.get_object(bucket, self.object_name)
+            try:
+                if self.path is not None:
+                    out = open(self.path, "wb")
+                for chunk in response.stream(PROGRESSIVE_CHUNK_SIZE):
+                    if self._cancelled:
+                        return
+                    if out is not None:
+                        out.write(chunk)
+                        out.flush()
+                    else:
+                        end = self._received + len(chunk)
+                        self._buffer[self._received : end] = chunk
+                    with self._cond:
+                        self._received += len(chunk)
+                        self._cond.notify_all()
+            finally:
+                response.close()
+                response.release_conn()
+            if self._received != self.size:
+                raise IOError(
+                    f"Incomplete download of {self.object_name}: "
+                    f"{self._received} of {self.size} bytes"
+                )
+        except BaseException as e:
+            self._error = e
+        finally:
+            if out is not None:
+                out.close()
+            with self._cond:
+                self._done = True
+                self._cond.notify_all()
+
+    def _wait(self, size: int):
+        with self._cond:
+            self._cond.wait_for(lambda: self._received >= size or self._done)
+        if self._error is not None:
+            raise self._error
+        if self._received < size:
+            raise IOError(f"Download of {self.object_name} was cancelled")
+
+    def _head(self, size: int) -> bytes:
+        self._wait(size)
+        if self.path is None:
+            return bytes(self._buffer[:size])
+        with open(self.path, "rb") as f:
+            return f.read(size)
+
+    async def read_head(self, size: int) -> bytes:
+        """The first `size` bytes of the object, once they have arrived."""
+        size = min(size, self.size)
+        return await asyncio.get_event_loop().run_in_executor(None, self._head, size)
+
+    @property
+    def complete(self) -> bool:
+        """Whether the whole object arrived without errors."""
+        with self._cond:
+            return self._done and self._error is None and self._received == self.size
+
+    def save(self, path: str):
+        """Move a complete download to `path`."""
+        if self.path is None:
+            with open(path, "wb") as f:
+                f.write(self._buffer)
+        else:
+            shutil.move(self.path, path)
+            self.path = path
+
+    async def result(self) -> Union[str, bytes]:
+        """The whole object, as bytes or a local path, once downloaded."""
+        await asyncio.get_event_loop().run_in_executor(None, self._wait, self.size)
+        return self._buffer if self.path is None else self.path
+
+    def close(self):
+        self._cancelled = True
+        self._thread.join()
+
+
+class ObjectCache:
+    """
+    Bounded on-disk LRU of downloaded MinIO objects. Entries are keyed by
+    bucket, object name and ETag, so a changed object never produces a stale hit.
+    Entries handed out with `acquire` are pinned and skipped by eviction until
+    they are released.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = DEFAULT_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._pins: Dict[str, int] = {}
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        # rebuild the index from a previous run, least recently used first
+        files = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith(".part"):
+                os.unlink(path)
+            elif os.path.isfile(path):
+                st = os.stat(path)
+                files.append((st.st_mtime, name, st.st_size))
+        for _, name, size in sorted(files):
+            self._entries[name] = size
+            self._total_bytes += size
+        with self._lock:
+            self._evict()
+
+    @staticmethod
+    def key(bucket: str, object_name: str, etag: str) -> str:
+        digest = hashlib.sha1(f"{bucket}/{object_name}/{etag}".encode()).hexdigest()
+        return digest + os.path.splitext(object_name)[1]
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key)
+
+    def acquire(self, key: str) -> Optional[str]:
+        """Return the pinned path of a cached entry, or None on a miss."""
+        with self._lock:
+            if key in self._entries and os.path.exists(self.path(key)):
+                self._entries.move_to_end(key)
+                # mtime doubles as the LRU order when the index is rebuilt
+                os.utime(self.path(key))
+                self._pins[key] = self._pins.get(key, 0) + 1
+                self.hits += 1
+                return self.path(key)
+            self.misses += 1
+            return None
+
+    def release(self, key: str):
+        with self._lock:
+            count = self._pins.get(key, 0) - 1
+            if count > 0:
+                self._pins[key] = count
+            else:
+                self._pins.pop(key, None)
+            self._evict()
+
+    def put_file(self, key: str, fetch: Callable[[str], None]) -> str:
+        """Fill an entry with `fetch(path)` and return its pinned path."""
+        part_path = f"{self.path(key)}.{threading.get_ident()}.part"
+        try:
+            fetch(part_path)
+            os.replace(part_path, self.path(key))
+        finally:
+            if os.path.exists(part_path):
+                os.unlink(part_path)
+        size = os.path.getsize(self.path(key))
+        with self._lock:
+            if key in self._entries:
+                self._total_bytes -= self._entries[key]
+            self._entries[key] = size
+            self._total_bytes += size
+            self._pins[key] = self._pins.get(key, 0) + 1
+            self._evict()
+        return self.path(key)
+
+    def put_bytes(self, key: str, data: bytes):
+        def write(path: str):
+            with open(path, "wb") as f:
+                f.write(data)
+
+        self.put_file(key, write)
+        self.release(key)
+
+    def _evict(self):
+        # caller holds the lock
+        for key in list(self._entries):
+            if self._total_bytes <= self.max_bytes:
+                break
+            if key in self._pins:
+                continue
+            self._total_bytes -= self._entries.pop(key)
+            self.evictions += 1
+            try:
+                os.unlink(self.path(key))
+            except FileNotFoundError:
+                pass
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+            }
+
+
+_object_cache: Optional[ObjectCache] = None
+_object_cache_lock = threading.Lock()
+
+
+def get_object_cache() -> Optional[ObjectCache]:
+    """Process-wide object cache, enabled by setting MINIO_CACHE_DIR."""
+    global _object_cache
+    cache_dir = os.getenv("MINIO_CACHE_DIR")
+    if not cache_dir:
+        return None
+    with _object_cache_lock:
+        if _object_cache is None:
+            _object_cache = ObjectCache(
+                cache_dir,
+                int(os.getenv("MINIO_CACHE_MAX_BYTES", DEFAULT_CACHE_MAX_BYTES)),
+            )
+        return _object_cache
+
+
+class StorageConfig:
+    def __init__(
+        self,
+        storage_type: str,
+        minio_bucket: Optional[str] = None,
+        memory_threshold: Optional[int] = None,
+        progressive_threshold: Optional[int] = None,
+    ):
+        self.storage_type = storage_type
+        self.minio_bucket = minio_bucket
+        if memory_threshold is None:
+            memory_threshold = int(
+                os.getenv("MINIO_MEMORY_THRESHOLD", DEFAULT_MEMORY_THRESHOLD)
+            )
+        self.memory_threshold = memory_threshold
+        if progressive_threshold is None:
+            progressive_threshold = int(
+                os.getenv("MINIO_PROGRESSIVE_THRESHOLD", DEFAULT_PROGRESSIVE_THRESHOLD)
+            )
+        self.progressive_threshold = progressive_threshold
+        if storage_type == "MINIO":
+            self.minio_client = Minio(
+                os.getenv("MINIO_ENDPOINT", "localhost:9000"),
+                access_key=os.getenv("MINIO_ACCESS_KEY"),
+                secret_key=os.getenv("MINIO_SECRET_KEY"),
+                secure=False,
+            )
+
+    @staticmethod
+    def _check_local_file(file_path: str):
+        if not os.path.exists(file_path):
+            raise FileNotFoundError(f"File not found: {file_path}")
+        if not os.path.isfile(file_path):
+            raise IsADirectoryError(f"Path is a directory: {file_path}")
+
+    @staticmethod
+    def _object_name(file_path: str) -> str:
+        if file_path.startswith("file/"):
+            return file_path
+        object_name = os.path.basename(file_path)
+        if not object_name:
+            raise ValueError(f"Invalid file path: {file_path}")
+        return object_name
+
+    def is_collection(self, file_path: str) -> bool:
+        """Whether `file_path` names a local directory or a MinIO prefix ("…/")."""
+        if self.storage_type == "LOCAL":
+            return os.path.isdir(file_path)
+        return file_path.endswith("/")
+
+    def list_documents(
+        self, file_path: str, extensions: Sequence[str] = (".pdf",)
+    ) -> List[str]:
+        """Recursively list the files under a collection with one of `extensions`."""
+        extensions = tuple(ext.lower() for ext in extensions)
+        if self.storage_type == "LOCAL":
+            documents = [
+                os.path.join(root, name)
+                for root, _, names in os.walk(file_path)
+                for name in names
+                if name.lower().endswith(extensions)
+            ]
+        else:
+            documents = [
+                obj.object_name
+                for obj in self.minio_client.list_objects(
+                    self.minio_bucket, prefix=file_path.lstrip("/"), recursive=True
+                )
+                if not obj.is_dir and obj.object_name.lower().endswith(extensions)
+            ]
+        return sorted(documents)
+
+    def _get_object_bytes(self, object_name: str) -> bytes:
+        response = self.minio_client.get_object(self.minio_bucket, object_name)
+        try:
+            return response.read()
+        finally:
+            response.close()
+            response.release_conn()
+
+    @staticmethod
+    def _cache_download(cache: ObjectCache, key: str, download: ProgressiveDownload):
+        try:
+            cache.put_file(key, download.save)
+            cache.release(key)
+        except Exception as e:
+            # the object was parsed already, only the cache entry is lost
+            logger.warning(f"Caching {download.object_name} failed: {e}")
+
+    @asynccontextmanager
+    async def open_file(
+        self,
+        file_path: str,
+        in_memory: bool = True,
+        exact_name: bool = False,
+        progressive: bool = False,
+    ) -> AsyncIterator[Union[str, bytes, ProgressiveDownload]]:
+        """
+        Yield the content of `file_path` either as raw bytes or as a local path.
+        MinIO objects no larger than `memory_threshold` are read straight into
+        memory when `in_memory` is set; larger objects spill to a temporary file.
+        Anything downloaded here is removed when the context exits, except for
+        entries of the shared object cache (see `get_object_cache`).
+        With `exact_name`, `file_path` is used as the object name verbatim, as
+        for names returned by `list_documents`. With `progressive`, uncached
+        objects above `progressive_threshold` are yielded as a
+        `ProgressiveDownload` that is still in flight; once complete, it is
+        added to the object cache on exit.
+        """
+        if self.storage_type == "LOCAL":
+            self._check_local_file(file_path)
+            yield file_path
+            return
+
+        loop = asyncio.get_event_loop()
+        object_name = file_path if exact_name else self._object_name(file_path)
+        cache = get_object_cache()
+        data, temp_path, cache_key, cached_path = None, None, None, None
+        download = None
+        try:
+            stat = await loop.run_in_executor(
+                None,
+                lambda: self.minio_client.stat_object(self.minio_bucket, object_name),
+            )
+            cacheable = cache is not None and stat.size <= cache.max_bytes
+            if cacheable:
+                cache_key = cache.key(self.minio_bucket, object_name, stat.etag)
+                cached_path = cache.acquire(cache_key)
+
+            if cached_path is not None:
+                logger.info(
+                    f"MinIO cache hit - bucket: {self.minio_bucket}, "
+                    f"object: {object_name}, stats: {cache.stats()}"
+                )
+            elif progressive and 0 < self.progressive_threshold < stat.size:
+                # cache misses stream too, the finished download fills the cache
+                logger.info(
+                    f"Streaming from MinIO - bucket: {self.minio_bucket}, "
+                    f"object: {object_name}, size: {stat.size}"
+                )
+                if not in_memory or stat.size > self.memory_threshold:
+                    fd, temp_path = tempfile.mkstemp(
+                        suffix=os.path.splitext(object_name)[1]
+                    )
+                    os.close(fd)
+                download = ProgressiveDownload(
+                    self.minio_client,
+                    self.minio_bucket,
+                    object_name,
+                    stat.size,
+                    temp_path,
+                )
+            elif in_memory and stat.size <= self.memory_threshold:
+                logger.info(
+                    f"Reading from MinIO into memory - bucket: {self.minio_bucket}, "
+                    f"object: {object_name}, size: {stat.size}"
+                )
+                data = await loop.run_in_executor(
+                    None, self._get_object_bytes, object_name
+                )
+                if cacheable:
+                    await loop.run_in_executor(None, cache.put_bytes, cache_key, data)
+            elif cacheable:
+                logger.info(
+                    f"Downloading from MinIO into cache - bucket: {self.minio_bucket}, "
+                    f"object: {object_name}, size: {stat.size}"
+                )
+                cached_path = await loop.run_in_executor(
+                    None,
+                    cache.put_file,
+                    cache_key,
+                    lambda path: self.minio_client.fget_object(
+                        self.minio_bucket, object_name, path
+                    ),
+                )
+            else:
+                logger.info(
+                    f"Downloading from MinIO - bucket: {self.minio_bucket}, "
+                    f"object: {object_name}, size: {stat.size}"
+                )
+                fd, temp_path = tempfile.mkstemp(
+                    suffix=os.path.splitext(object_name)[1]
+                )
+                os.close(fd)
+                await loop.run_in_executor(
+                    None,
+                    lambda: self.minio_client.fget_object(
+                        self.minio_bucket, object_name, temp_path
+                    ),
+                )
+        except Exception as e:
+            logger.error(f"MinIO download error: {e}")
+            if temp_path is not None and os.path.exists(temp_path):
+                os.unlink(temp_path)
+            if cached_path is not None:
+                cache.release(cache_key)
+            raise
+
+        try:
+            if download is not None:
+                yield download
+            elif cached_path is not None:
+                yield cached_path
+            else:
+                yield data if temp_path is None else temp_path
+        finally:
+            if download is not None:
+                await loop.run_in_executor(None, download.close)
+                if cacheable and download.complete:
+                    await loop.run_in_executor(
+                        None, self._cache_download, cache, cache_key, download
+                    )
+            if temp_path is not None and os.path.exists(temp_path):
+                os.unlink(temp_path)
+            if cached_path is not None:
+                cache.release(cache_key)
@@ -0,0 +1,36 @@
+import numpy as np
+
+from modules.layoutlmv3.detections import LayoutDetections
+
+
+def make_detections():
+    return LayoutDetections(
+        [[0, 0, 10, 10], [5, 5, 20, 20], [1, 2, 3, 4]],
+        [1, 3, 1],
+        [0.9, 0.5, 0.2],
+    )
+
+
+def test_mask_index():
+    detections = make_detections()
+    kept = detections[detections.scores > 0.3]
+    assert len(kept) == 2
+    assert kept.labels.tolist() == [1, 3]
+    assert kept.boxes.tolist() == [[0, 0, 10, 10], [5, 5, 20, 20]]
+
+
+def test_empty_mask_index():
+    detections = make_detections()
+    kept = detections[np.zeros(len(detections), dtype=bool)]
+    assert len(kept) == 0
+    assert kept.boxes.shape == (0, 4)
+
+
+def test_layout_dets_key():
+    detections = make_detections()
+    assert detections["layout_dets"] == detections.layout_dets
+    assert detections["layout_dets"][0] == {
+        "category_id": 1,
+        "poly": [0.0, 0.0, 10.0, 0.0, 10.0, 10.0, 0.0, 10.0],
+        "score": detections.scores[0].item(),
+    }
@@ -0,0 +1,110 @@
+"""
+Check the fused scaled-dot-product attention paths against the explicit
+attention they replace, on random weights at page-sized token counts.
+Run from the repository root:
+
+    python tools/check_attention.py --height 800 --width 608
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.layoutlmv3.beit import Attention as BeitAttention  # noqa: E402
+from modules.layoutlmv3.layoutlmft.models.layoutlmv3.configuration_layoutlmv3 import (  # noqa: E402
+    LayoutLMv3Config,
+)
+from modules.layoutlmv3.layoutlmft.models.layoutlmv3.modeling_layoutlmv3 import (  # noqa: E402
+    LayoutLMv3SelfAttention,
+)
+
+
+def run(module, fused, *args, **kwargs):
+    module.fused_attn = fused
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.perf_counter()
+    with torch.no_grad():
+        out = module(*args, **kwargs)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter() - start
+    peak = torch.cuda.max_memory_allocated() if torch.cuda.is_available() else 0
+    return (out[0] if isinstance(out, tuple) else out), elapsed, peak
+
+
+def report(name, module, tolerance, *args, **kwargs):
+    run(module, True, *args, **kwargs)  # warm-up
+    explicit, explicit_time, explicit_peak = run(module, False, *args, **kwargs)
+    fused, fused_time, fused_peak = run(module, True, *args, **kwargs)
+    error = (explicit - fused).abs().max().item()
+    status = "ok" if error <= tolerance else "MISMATCH"
+    print(
+        f"{name}: max abs diff {error:.2e} ({status}), "
+        f"explicit {1000 * explicit_time:.1f} ms, fused {1000 * fused_time:.1f} ms"
+        + (
+            f", peak memory {explicit_peak / 2**20:.0f} -> {fused_peak / 2**20:.0f} MiB"
+            if torch.cuda.is_available()
+            else ""
+        )
+    )
+    return error <= tolerance
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--height", type=int, default=800)
+    parser.add_argument("--width", type=int, default=608)
+    parser.add_argument("--dtype", default="float32", choices=["float32", "float16"])
+    parser.add_argument("--tolerance", type=float, default=None)
+    args = parser.parse_args()
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    dtype = getattr(torch, args.dtype)
+    tolerance = args.tolerance or (1e-4 if dtype == torch.float32 else 1e-2)
+    torch.manual_seed(0)
+    hp, wp = args.height // 16, args.width // 16
+    tokens = hp * wp + 1  # patches and the cls token
+    print(f"{tokens} tokens on {device} in {args.dtype}")
+
+    config = LayoutLMv3Config()
+    config.has_relative_attention_bias = False
+    config.has_spatial_attention_bias = False
+    layoutlmv3 = LayoutLMv3SelfAttention(config).to(device, dtype).eval()
+    layoutlmv3.use_cogview_attn = False
+    hidden = torch.randn(1, tokens, config.hidden_size, device=device, dtype=dtype)
+    mask = torch.zeros(1, 1, 1, tokens, device=device, dtype=dtype)
+    mask[..., -tokens // 10 :] = torch.finfo(dtype).min
+    ok = report("LayoutLMv3SelfAttention", layoutlmv3, tolerance, hidden)
+    ok &= report(
+        "LayoutLMv3SelfAttention, masked",
+        layoutlmv3,
+        tolerance,
+        hidden,
+        attention_mask=mask,
+    )
+
+    beit = BeitAttention(768, num_heads=12, qkv_bias=True, window_size=(hp, wp))
+    beit = beit.to(device, dtype).eval()
+    with torch.no_grad():
+        beit.relative_position_bias_table.normal_(std=0.02)
+    rel_pos_bias = 0.02 * torch.randn(1, 12, tokens, tokens, device=device, dtype=dtype)
+    ok &= report(
+        "BEiT Attention, relative position bias",
+        beit,
+        tolerance,
+        hidden,
+        rel_pos_bias=rel_pos_bias,
+        training_window_size=(hp, wp),
+    )
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Export the backbone and FPN of the layout detector to ONNX for the "onnx"
+layout backend. RPN, ROI heads and postprocessing are not exported; the onnx
+backend runs them in PyTorch on the feature maps the graph returns. Run from
+the repository root:
+
+    python tools/export_onnx.py --weights ./weights/model_final.pth
+
+With PDF files or page images, the ONNX Runtime build is then compared
+against the PyTorch build on CPU, for agreement and per-page latency:
+
+    python tools/export_onnx.py --weights ./weights/model_final.pth docs/*.pdf
+"""
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from layout_agreement import compare, load_pages  # noqa: E402
+from modules.layoutlmv3.model_init import Layoutlmv3_Predictor  # noqa: E402
+from modules.layoutlmv3.onnx_backend import export_backbone  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("inputs", nargs="*", help="PDF files or page images")
+    parser.add_argument("--weights", default="./weights/model_final.pth")
+    parser.add_argument("--output", default="./weights/layout_backbone.onnx")
+    parser.add_argument("--height", type=int, default=800, help="trace input height")
+    parser.add_argument("--width", type=int, default=608, help="trace input width")
+    parser.add_argument("--opset", type=int, default=17)
+    parser.add_argument("--threads", type=int, default=0, help="intra-op threads")
+    parser.add_argument("--dpi", type=int, default=200)
+    parser.add_argument("--iou", type=float, default=0.9)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    reference = Layoutlmv3_Predictor(args.weights, device="cpu")
+    names = export_backbone(
+        reference.predictor.model.backbone,
+        args.output,
+        height=args.height,
+        width=args.width,
+        opset=args.opset,
+    )
+    print(f"exported backbone and FPN ({', '.join(names)}) to {args.output}")
+    if not args.inputs:
+        return
+
+    candidate = Layoutlmv3_Predictor(
+        args.weights,
+        device="cpu",
+        backend="onnx",
+        onnx={"path": args.output, "intra_op_threads": args.threads},
+    )
+    compare(
+        reference,
+        candidate,
+        load_pages(args.inputs, args.dpi),
+        iou_threshold=args.iou,
+        verbose=args.verbose,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+"""
+Compare a build of the layout detector against the reference build on PDF
+pages or images: detections are matched by class and IoU, and per-page
+latency is reported for both. Run from the repository root:
+
+    python tools/layout_agreement.py --weights ./weights/model_final.pth docs/*.pdf
+
+With --token-pruning the candidate drops blank page patches, e.g.
+
+    python tools/layout_agreement.py --token-pruning --prune-tolerance 0.04 docs/*.pdf
+
+and with --quantization int8_dynamic it is quantized for CPU, both builds then
+running on CPU; --fpn-calibration adds statically quantized FPN convolutions
+
+    python tools/layout_agreement.py --quantization int8_dynamic \
+        --fpn-calibration 'calib/*.pdf' docs/*.pdf
+
+--precision fp16 or bf16 runs the candidate's backbone under autocast.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.extract_pdf import open_pdf, render_page  # noqa: E402
+from modules.layoutlmv3.model_init import Layoutlmv3_Predictor  # noqa: E402
+
+
+def load_pages(paths, dpi):
+    for path in paths:
+        if path.lower().endswith(".pdf"):
+            doc = open_pdf(path)
+            try:
+                for page_idx in range(len(doc)):
+                    yield f"{path}#{page_idx}", render_page(doc[page_idx], dpi).image
+            finally:
+                doc.close()
+        else:
+            yield path, cv2.imread(path)
+
+
+def boxes(result):
+    return list(
+        zip(
+            result.labels.tolist(),
+            result.scores.tolist(),
+            map(tuple, result.boxes.tolist()),
+        )
+    )
+
+
+def iou(a, b):
+    w = min(a[2], b[2]) - max(a[0], b[0])
+    h = min(a[3], b[3]) - max(a[1], b[1])
+    if w <= 0 or h <= 0:
+        return 0.0
+    inter = w * h
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union
+
+
+def match(reference, candidate, iou_threshold):
+    """Greedy one-to-one matching of same-class boxes, highest IoU first."""
+    pairs = [
+        (iou(r[2], c[2]), i, j)
+        for i, r in enumerate(reference)
+        for j, c in enumerate(candidate)
+        if r[0] == c[0]
+    ]
+    used_r, used_c, matched = set(), set(), []
+    for overlap, i, j in sorted(pairs, reverse=True):
+        if overlap < iou_threshold:
+            break
+        if i in used_r or j in used_c:
+            continue
+        used_r.add(i)
+        used_c.add(j)
+        matched.append((overlap, abs(reference[i][1] - candidate[j][1])))
+    return matched
+
+
+def timed(predictor, image):
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    result = predictor(image)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return result, time.perf_counter() - start
+
+
+def compare(reference, candidate, pages, iou_threshold=0.9, verbose=False):
+    totals = {"ref": 0, "cand": 0, "matched": 0, "ref_time": [], "cand_time": []}
+    min_iou, max_score_delta = 1.0, 0.0
+    warm = False
+    for name, image in pages:
+        if not warm:
+            # first calls pay for cuDNN autotuning and allocator growth
+            reference(image)
+            candidate(image)
+            warm = True
+        ref_res, ref_time = timed(reference, image)
+        cand_res, cand_time = timed(candidate, image)
+        ref_boxes, cand_boxes = boxes(ref_res), boxes(cand_res)
+        matched = match(ref_boxes, cand_boxes, iou_threshold)
+        totals["ref"] += len(ref_boxes)
+        totals["cand"] += len(cand_boxes)
+        totals["matched"] += len(matched)
+        totals["ref_time"].append(ref_time)
+        totals["cand_time"].append(cand_time)
+        for overlap, score_delta in matched:
+            min_iou = min(min_iou, overlap)
+            max_score_delta = max(max_score_delta, score_delta)
+        if verbose or len(matched) != max(len(ref_boxes), len(cand_boxes)):
+            print(
+                f"{name}: reference {len(ref_boxes)}, candidate {len(cand_boxes)}, "
+                f"matched {len(matched)}"
+            )
+
+    pages_seen = len(totals["ref_time"])
+    if not pages_seen:
+        print("no pages")
+        return totals
+    agreement = totals["matched"] / max(totals["ref"], totals["cand"], 1)
+    print(f"pages: {pages_seen}")
+    print(
+        f"detections: reference {totals['ref']}, candidate {totals['cand']}, "
+        f"matched {totals['matched']} ({agreement:.2%} at IoU >= {iou_threshold})"
+    )
+    print(f"min matched IoU: {min_iou:.4f}, max score delta: {max_score_delta:.4f}")
+    ref_ms = 1000 * np.mean(totals["ref_time"])
+    cand_ms = 1000 * np.mean(totals["cand_time"])
+    print(
+        f"latency per page: reference {ref_ms:.1f} ms, candidate {cand_ms:.1f} ms "
+        f"({ref_ms / cand_ms:.2f}x)"
+    )
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("inputs", nargs="+", help="PDF files or page images")
+    parser.add_argument("--weights", default="./weights/model_final.pth")
+    parser.add_argument("--profile", default="inference", help="candidate profile")
+    parser.add_argument("--dpi", type=int, default=200)
+    parser.add_argument("--iou", type=float, default=0.9)
+    parser.add_argument("--verbose", action="store_true")
+    parser.add_argument("--token-pruning", action="store_true")
+    parser.add_argument("--prune-tolerance", type=float, default=0.04)
+    parser.add_argument("--prune-margin", type=int, default=1)
+    parser.add_argument("--quantization", default="none", help="none or int8_dynamic")
+    parser.add_argument("--fpn-calibration", nargs="*", default=[])
+    parser.add_argument("--calibration-pages", type=int, default=32)
+    parser.add_argument("--device", default=None, help="defaults to the config's")
+    parser.add_argument("--precision", default="fp32", help="fp32, fp16 or bf16")
+    args = parser.parse_args()
+
+    token_pruning = None
+    if args.token_pruning:
+        token_pruning = {"tolerance": args.prune_tolerance, "margin": args.prune_margin}
+    device = args.device
+    if args.quantization != "none":
+        device = "cpu"
+    reference = Layoutlmv3_Predictor(args.weights, profile="reference", device=device)
+    candidate = Layoutlmv3_Predictor(
+        args.weights,
+        profile=args.profile,
+        token_pruning=token_pruning,
+        device=device,
+        quantization={
+            "mode": args.quantization,
+            "fpn_calibration": args.fpn_calibration,
+            "calibration_pages": args.calibration_pages,
+            "calibration_dpi": args.dpi,
+        },
+        precision=args.precision,
+    )
+    compare(
+        reference,
+        candidate,
+        load_pages(args.inputs, args.dpi),
+        iou_threshold=args.iou,
+        verbose=args.verbose,
+    )
+
+
+if __name__ == "__main__":
+    main()